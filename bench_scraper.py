@@ -0,0 +1,267 @@
+"""Offline benchmark of the scrapers
+
+Starts scrape_replay.py on a free port and points StockScraper and
+CryptoScraper at it, so a refresh can be timed without the network and
+gives the same numbers every time. For every number of symbols, parser
+backend and fetch concurrency it runs one stock refresh with an empty
+HTTP cache and reports
+
+    seconds   the whole refresh: fetch, parse, cache and stocks.csv
+    pages/s   symbols / seconds
+    parse ms  mean, p50 and p99 CPU time of parse_page per page. CPU
+              time of the parsing thread, because with several fetch
+              threads the wall time mostly measures waiting for the GIL
+    failed    pages that gave no row (see --failure-rate)
+    peak MB   how far the resident memory of the process grew during
+              the refresh, sampled from /proc (None where there is none)
+
+    python bench_scraper.py
+    python bench_scraper.py --symbols 100,1000 --backends fast,strainer --workers 4,8,16
+    python bench_scraper.py --fixtures fixtures --latency 0.05 --jitter 0.05 --failure-rate 0.01
+
+--warm runs a second refresh on the same cache, where every page is a 304
+and nothing is parsed. The results and settings are written as JSON to
+--output, like bench_server.py.
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import threading
+from datetime import datetime
+
+from bench_server import free_port, git_commit, percentile
+
+DEFAULT_SYMBOLS = '10,100,1000,5000'
+HERE = os.path.dirname(os.path.abspath(__file__))
+RSS_INTERVAL = 0.01  # seconds between memory samples
+
+
+def resident_memory():
+    # resident bytes of this process, None where /proc is missing
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        return None
+
+
+class MemorySampler:
+    # Highest resident memory seen while running, minus where it started.
+    # Sampling keeps the refresh at full speed, tracemalloc slows the
+    # parsers down several times
+    def __init__(self, interval=RSS_INTERVAL):
+        # initialization of the class
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.start_rss = self.peak_rss = resident_memory()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.peak_rss = max(self.peak_rss, resident_memory())
+
+    def __enter__(self):
+        if self.start_rss is not None:
+            self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.start_rss is not None:
+            self.stopped.set()
+            self.thread.join()
+            self.peak_rss = max(self.peak_rss, resident_memory())
+
+    def growth(self):
+        return None if self.start_rss is None else self.peak_rss - self.start_rss
+
+
+def start_replay(port, args):
+    # scrape_replay.py in its own process, so serving pages does not take
+    # the scraper's CPU
+    command = [sys.executable, os.path.join(HERE, 'scrape_replay.py'), 'serve',
+               '--port', str(port), '--latency', str(args.latency), '--jitter', str(args.jitter),
+               '--failure-rate', str(args.failure_rate), '--page-size', str(args.page_size),
+               '--seed', str(args.seed)]
+    if args.fixtures:
+        command += ['--fixtures', os.path.abspath(args.fixtures)]
+    replay = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        if replay.poll() is not None:
+            raise RuntimeError(f'Replay server exited with code {replay.returncode}')
+        try:
+            socket.create_connection(('127.0.0.1', port)).close()
+            return replay
+        except OSError:
+            time.sleep(0.1)
+    replay.kill()
+    raise RuntimeError('Replay server did not start')
+
+
+def write_ticks(path, symbols):
+    with open(path, 'w') as f:
+        f.write('Symbol\n')
+        f.writelines(f'BENCH{i}\n' for i in range(symbols))
+
+
+def timed_parse(scraper, parse_times):
+    # make the scraper record the CPU time of each parse_page call
+    parse = scraper.parse_page
+
+    def parse_page(*args):
+        started = time.thread_time()
+        try:
+            return parse(*args)
+        finally:
+            parse_times.append(time.thread_time() - started)
+
+    scraper.parse_page = parse_page
+
+
+def refresh_stocks(server, directory, base_url, ticks, backend, workers, cache=None):
+    # one StockScraper refresh, returns (result dict, cache)
+    if cache is None:
+        fd, cache_path = tempfile.mkstemp(suffix='.db', dir=directory)
+        os.close(fd)
+        cache = server.HTTPCache(cache_path)
+    scraper = server.StockScraper(ticks, os.path.join(directory, 'stocks.csv'), max_workers=workers,
+                                  per_host=workers, delay=0, cache=cache, backend=backend,
+                                  base_url=base_url)
+    parse_times = []
+    timed_parse(scraper, parse_times)
+    with MemorySampler() as memory:
+        started = time.perf_counter()
+        try:
+            rows = scraper.scrape_data()
+        except RuntimeError:  # every page failed
+            rows = []
+        elapsed = time.perf_counter() - started
+    return {'elapsed': elapsed, 'rows': len(rows), 'parse_times': parse_times,
+            'memory': memory.growth()}, cache
+
+
+def refresh_crypto(server, directory, url, backend):
+    fd, cache_path = tempfile.mkstemp(suffix='.db', dir=directory)
+    os.close(fd)
+    scraper = server.CryptoScraper(url, cache=server.HTTPCache(cache_path), backend=backend)
+    parse_times = []
+    timed_parse(scraper, parse_times)
+    started = time.perf_counter()
+    try:
+        scraper.fetch_data()
+    except server.requests.exceptions.RequestException:
+        pass
+    return {'elapsed': time.perf_counter() - started, 'coins': len(scraper.crypto_names),
+            'parse_ms': round(parse_times[0] * 1000, 3) if parse_times else None}
+
+
+def summarize(symbols, backend, workers, run):
+    times = sorted(run['parse_times'])
+    return {
+        'symbols': symbols, 'backend': backend, 'workers': workers,
+        'seconds': round(run['elapsed'], 3),
+        'pages_per_s': round(symbols / run['elapsed'], 1),
+        'parse_mean_ms': round(statistics.fmean(times) * 1000, 3) if times else None,
+        'parse_p50_ms': round(percentile(times, 0.50) * 1000, 3) if times else None,
+        'parse_p99_ms': round(percentile(times, 0.99) * 1000, 3) if times else None,
+        'failed': symbols - run['rows'],
+        'peak_mb': round(run['memory'] / 2 ** 20, 1) if run['memory'] is not None else None,
+    }
+
+
+def number_list(text):
+    return [int(item) for item in text.split(',')]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline benchmark of the scrapers')
+    parser.add_argument('--symbols', type=number_list, default=number_list(DEFAULT_SYMBOLS),
+                        help='comma separated symbol counts (default: %(default)s)')
+    parser.add_argument('--backends', default=None,
+                        help='comma separated parser backends (default: the server default)')
+    parser.add_argument('--workers', type=number_list, default=None,
+                        help='comma separated fetch concurrency (default: the server default)')
+    parser.add_argument('--fixtures', help='pages recorded with scrape_replay.py record')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds per answer')
+    parser.add_argument('--jitter', type=float, default=0.0, help='up to this many seconds more')
+    parser.add_argument('--failure-rate', type=float, default=0.0, help='share of 503 answers')
+    parser.add_argument('--page-size', type=int, default=150 * 1024, help='bytes of a made-up page')
+    parser.add_argument('--warm', action='store_true', help='also time a refresh of unchanged pages')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='bench_scraper.json', help='JSON results file')
+    args = parser.parse_args()
+    output = os.path.abspath(args.output)
+    sys.path.insert(0, HERE)
+    import server
+
+    with tempfile.TemporaryDirectory() as directory:
+        # StockScraper logs to webscraping.log in the working directory unless
+        # logging is set up already, keep it with the other files
+        logging.basicConfig(filename=os.path.join(directory, 'webscraping.log'), level=logging.DEBUG)
+        backends = args.backends.split(',') if args.backends else [server.SCRAPE_BACKEND]
+        workers_list = args.workers or [server.SCRAPE_WORKERS]
+        port = free_port()
+        replay = start_replay(port, args)
+        base_url = f'http://127.0.0.1:{port}/quotes/'
+        runs, warm, crypto = [], [], {}
+        try:
+            for backend in backends:
+                crypto[backend] = refresh_crypto(server, directory, f'http://127.0.0.1:{port}/', backend)
+            for symbols in args.symbols:
+                ticks = os.path.join(directory, f'ticks{symbols}.csv')
+                write_ticks(ticks, symbols)
+                for backend in backends:
+                    for workers in workers_list:
+                        run, cache = refresh_stocks(server, directory, base_url, ticks, backend, workers)
+                        runs.append(summarize(symbols, backend, workers, run))
+                        if args.warm:
+                            again = refresh_stocks(server, directory, base_url, ticks, backend,
+                                                   workers, cache=cache)[0]
+                            warm.append(summarize(symbols, backend, workers, again))
+        finally:
+            replay.terminate()
+            replay.wait()
+            logging.shutdown()
+
+    header = (f"{'symbols':>8} {'backend':<9}{'workers':>8}{'seconds':>9}{'pages/s':>9}"
+              f"{'parse ms':>10}{'p50':>8}{'p99':>8}{'failed':>8}{'peak MB':>9}")
+    for title, rows in (('cold cache', runs), ('warm cache', warm)):
+        if not rows:
+            continue
+        print(title)
+        print(header)
+        for row in rows:
+            print(f"{row['symbols']:>8} {row['backend']:<9}{row['workers']:>8}{row['seconds']:>9}"
+                  f"{row['pages_per_s']:>9}{str(row['parse_mean_ms']):>10}{str(row['parse_p50_ms']):>8}"
+                  f"{str(row['parse_p99_ms']):>8}{row['failed']:>8}{str(row['peak_mb']):>9}")
+    for backend, row in crypto.items():
+        print(f"crypto page ({backend}): {row['coins']} coins in {row['elapsed']:.3f}s, "
+              f"parse {row['parse_ms']} ms")
+
+    with open(output, 'w') as f:
+        json.dump({
+            'started': datetime.now().isoformat(timespec='seconds'),
+            'commit': git_commit(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'settings': {'symbols': args.symbols, 'backends': backends, 'workers': workers_list,
+                         'fixtures': args.fixtures, 'latency': args.latency, 'jitter': args.jitter,
+                         'failure_rate': args.failure_rate, 'page_size': args.page_size,
+                         'seed': args.seed},
+            'runs': runs,
+            'warm': warm,
+            'crypto': crypto,
+        }, f, indent=2)
+    print(f'Results written to {output}')
+
+
+if __name__ == '__main__':
+    main()
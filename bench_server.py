@@ -0,0 +1,259 @@
+"""Load test for the server
+
+Starts a server on a free port with a new users.db in a temporary
+directory, registers one account per simulated client, and then lets
+every client send a weighted mix of requests as fast as the server
+answers them. Each request's latency is recorded, and the report gives
+throughput and p50/p99/p999 latency per action:
+
+    python bench_server.py --clients 50 --duration 20
+    python bench_server.py --mode thread --mix get_balance=8,deposit=1,invest=1
+
+The same numbers and the settings they were measured with (including the
+git commit, if there is one) are written as JSON to --output, so runs on
+different commits can be compared.
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+from protocol import send_frame, recv_frame, make_request, split_response
+
+ACTIONS = ('login', 'get_balance', 'deposit', 'withdraw', 'invest', 'sell_stock')
+DEFAULT_MIX = 'login=1,get_balance=10,deposit=3,withdraw=1,invest=2,sell_stock=1'
+SYMBOLS = ['Bench Corp %d' % i for i in range(20)]  # priced from stocks.csv
+PASSWORD = 'benchmark'
+START_BALANCE = 10 ** 9
+
+
+class BenchClient:
+    # One connection, one request at a time
+    def __init__(self, port):
+        # initialization of the class
+        self.sock = socket.create_connection(('127.0.0.1', port))
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.request_id = 0
+
+    def request(self, action, *args):
+        self.request_id += 1
+        send_frame(self.sock, make_request(str(self.request_id), action, *args))
+        while True:
+            text = recv_frame(self.sock)
+            if text is None:
+                raise ConnectionError('Server closed the connection')
+            response_id, response = split_response(text)
+            if response_id == str(self.request_id):
+                return response
+
+    def close(self):
+        self.sock.close()
+
+
+def parse_mix(text):
+    # 'login=1,deposit=3' -> {'login': 1.0, 'deposit': 3.0}
+    mix = {}
+    for item in text.split(','):
+        action, _, weight = item.partition('=')
+        if action not in ACTIONS:
+            raise ValueError(f'Unknown action in mix: {action}')
+        mix[action] = float(weight or 1)
+    return mix
+
+
+def percentile(ordered, fraction):
+    # nearest rank percentile of a sorted list
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, max(0, int(round(fraction * len(ordered) + 0.5)) - 1))]
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start_server(directory, port, mode, workers):
+    # the server in its own process, with its files in directory
+    with open(os.path.join(directory, 'stocks.csv'), 'w') as f:
+        f.write('Name,Last Trade Time,Last Price\n')
+        for i, symbol in enumerate(SYMBOLS):
+            f.write(f'{symbol},N/A,{100 + i}.00\n')
+    server = subprocess.Popen(
+        [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'server.py'),
+         '--mode', mode, '--workers', str(workers), '--port', str(port),
+         '--db', os.path.join(directory, 'users.db'), '--no-refresh'],
+        cwd=directory, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError(f'Server exited with code {server.returncode}')
+        try:
+            socket.create_connection(('127.0.0.1', port)).close()
+            return server
+        except OSError:
+            time.sleep(0.1)
+    server.kill()
+    raise RuntimeError('Server did not start')
+
+
+def build_request(action, username, rng):
+    if action == 'login':
+        return action, (username, PASSWORD)
+    if action == 'get_balance':
+        return action, (username,)
+    if action in ('deposit', 'withdraw'):
+        return action, (username, rng.randint(1, 100))
+    symbol = rng.choice(SYMBOLS)
+    if action == 'invest':
+        return action, (username, symbol, rng.randint(1, 5), 0, 'buy')
+    return action, (username, symbol, 1)
+
+
+def is_error(action, response):
+    if response.startswith('Error'):
+        return True
+    if action == 'login':
+        return not response.startswith('Login successful')
+    return False
+
+
+def run_client(port, username, mix, stop, seed, results):
+    # send requests until stop is set, results[action] gets the latencies
+    rng = random.Random(seed)
+    actions, weights = list(mix), list(mix.values())
+    latencies = {action: [] for action in actions}
+    errors = {action: 0 for action in actions}
+    client = BenchClient(port)
+    try:
+        while not stop.is_set():
+            action, args = build_request(rng.choices(actions, weights)[0], username, rng)
+            started = time.perf_counter()
+            response = client.request(action, *args)
+            latencies[action].append(time.perf_counter() - started)
+            if is_error(action, response):
+                errors[action] += 1
+    finally:
+        client.close()
+    results.append((latencies, errors))
+
+
+def prepare_accounts(port, clients):
+    # one account per client, with enough money and some of every symbol
+    client = BenchClient(port)
+    try:
+        for i in range(clients):
+            username = f'bench{i}'
+            client.request('register', username, PASSWORD)
+            client.request('deposit', username, START_BALANCE)
+            for symbol in SYMBOLS:
+                client.request('invest', username, symbol, 1000, 0, 'buy')
+    finally:
+        client.close()
+
+
+def summarize(results, elapsed):
+    report = {}
+    for action in ACTIONS:
+        latencies = sorted(latency for client, errors in results for latency in client.get(action, []))
+        if not latencies:
+            continue
+        report[action] = {
+            'requests': len(latencies),
+            'errors': sum(errors.get(action, 0) for client, errors in results),
+            'throughput': round(len(latencies) / elapsed, 1),
+            'p50_ms': round(percentile(latencies, 0.50) * 1000, 3),
+            'p99_ms': round(percentile(latencies, 0.99) * 1000, 3),
+            'p999_ms': round(percentile(latencies, 0.999) * 1000, 3),
+            'max_ms': round(latencies[-1] * 1000, 3),
+        }
+    total = sum(row['requests'] for row in report.values())
+    return report, {'requests': total, 'throughput': round(total / elapsed, 1)}
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test for the server')
+    parser.add_argument('--clients', type=int, default=20, help='simulated clients')
+    parser.add_argument('--duration', type=float, default=10, help='seconds of load')
+    parser.add_argument('--warmup', type=float, default=1, help='seconds of load not measured')
+    parser.add_argument('--mix', default=DEFAULT_MIX, help='action=weight,... (default: %(default)s)')
+    parser.add_argument('--mode', choices=['async', 'thread'], default='async')
+    parser.add_argument('--workers', type=int, default=8, help='database threads of the asyncio server')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='bench_server.json', help='JSON results file')
+    args = parser.parse_args()
+    mix = parse_mix(args.mix)
+
+    with tempfile.TemporaryDirectory() as directory:
+        port = free_port()
+        server = start_server(directory, port, args.mode, args.workers)
+        try:
+            prepare_accounts(port, args.clients)
+            if args.warmup > 0:
+                stop = threading.Event()
+                threads = [threading.Thread(target=run_client, args=(
+                    port, f'bench{i}', mix, stop, -1 - i, [])) for i in range(args.clients)]
+                for thread in threads:
+                    thread.start()
+                time.sleep(args.warmup)
+                stop.set()
+                for thread in threads:
+                    thread.join()
+
+            results = []
+            stop = threading.Event()
+            threads = [threading.Thread(target=run_client, args=(
+                port, f'bench{i}', mix, stop, args.seed + i, results)) for i in range(args.clients)]
+            started = time.perf_counter()
+            for thread in threads:
+                thread.start()
+            time.sleep(args.duration)
+            stop.set()
+            for thread in threads:
+                thread.join()
+            elapsed = time.perf_counter() - started
+        finally:
+            server.terminate()
+            server.wait()
+
+    actions, total = summarize(results, elapsed)
+    print(f"{'action':<12}{'requests':>10}{'errors':>8}{'req/s':>10}{'p50 ms':>10}{'p99 ms':>10}{'p999 ms':>10}")
+    for action, row in actions.items():
+        print(f"{action:<12}{row['requests']:>10}{row['errors']:>8}{row['throughput']:>10}"
+              f"{row['p50_ms']:>10}{row['p99_ms']:>10}{row['p999_ms']:>10}")
+    print(f"{'total':<12}{total['requests']:>10}{'':>8}{total['throughput']:>10}")
+
+    with open(args.output, 'w') as f:
+        json.dump({
+            'started': datetime.now().isoformat(timespec='seconds'),
+            'commit': git_commit(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'settings': {'clients': args.clients, 'duration': args.duration, 'mix': mix,
+                         'mode': args.mode, 'workers': args.workers, 'seed': args.seed},
+            'elapsed': round(elapsed, 3),
+            'total': total,
+            'actions': actions,
+        }, f, indent=2)
+    print(f'Results written to {args.output}')
+
+
+if __name__ == '__main__':
+    main()
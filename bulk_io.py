@@ -0,0 +1,215 @@
+"""Bulk import and export of ledger data
+
+Loading accounts from another broker through the socket protocol costs a
+round trip and a ledger command per row. This tool reads or writes the
+users, portfolios and transactions tables directly, as CSV or JSON Lines:
+
+    python bulk_io.py export transactions transactions.jsonl
+    python bulk_io.py import users users.csv
+    python bulk_io.py import transactions big.jsonl --resume
+
+Rows flow through generators: the file is read a line at a time, grouped
+into chunks of --chunk rows and written with executemany. Every
+--commit-every chunks are one transaction. Memory use therefore does not
+depend on the size of the file.
+
+Each transaction also stores how far into the file it got, in the
+import_checkpoints table, and commits that with the rows. If an import
+fails, running it again with --resume skips the part that was already
+committed, and no row is imported twice.
+
+Imported ids are not kept, the database assigns new ones. Positions are
+added to existing ones like invest does. A running server does not see
+imported balances and positions until it restarts, because it caches
+accounts.
+"""
+import argparse
+import csv
+import itertools
+import json
+import os
+import sqlite3
+import sys
+
+from db_pool import ConnectionPool, PRAGMAS
+from migrations import migrate
+
+CHUNK_ROWS = 10000
+COMMIT_EVERY = 10  # chunks per transaction
+
+# columns read from an import file, anything else in it is ignored
+IMPORT_COLUMNS = {
+    'users': ('username', 'password', 'balance'),
+    'portfolios': ('username', 'market', 'quantity', 'amount'),
+    'transactions': ('username', 'transaction_type', 'amount', 'market', 'timestamp'),
+}
+
+INSERTS = {
+    'users': '''INSERT INTO users (username, password, balance)
+                VALUES (?, ?, COALESCE(?, 0))''',
+    'portfolios': '''INSERT INTO portfolios (username, market, quantity, amount) VALUES (?, ?, ?, ?)
+                     ON CONFLICT (username, market) DO UPDATE
+                     SET quantity = quantity + excluded.quantity, amount = amount + excluded.amount''',
+    'transactions': '''INSERT INTO transactions (username, transaction_type, amount, market, timestamp)
+                       VALUES (?, ?, ?, ?, COALESCE(?, CURRENT_TIMESTAMP))''',
+}
+
+# Bulk loads are redone from the file after a crash, so no fsync per
+# commit. Inserts land all over the transactions indexes, a bigger page
+# cache (256 MB) keeps them from going to disk for every row
+BULK_SETTINGS = {'synchronous': 'NORMAL', 'cache_size': -256 * 1024}
+BULK_PRAGMAS = tuple((name, BULK_SETTINGS.get(name, value)) for name, value in PRAGMAS)
+
+
+def file_format(path, fmt=None):
+    if fmt is not None:
+        return fmt
+    return 'jsonl' if path.endswith(('.jsonl', '.ndjson', '.json')) else 'csv'
+
+
+def _lines(f, offset, counter):
+    # decoded lines of a binary file from offset, counter[0] is the byte
+    # offset after the last line handed out
+    f.seek(offset)
+    counter[0] = offset
+    for line in f:
+        counter[0] += len(line)
+        yield line.decode('utf-8')
+
+
+def read_records(f, fmt, offset=0):
+    # (record dict, offset after it) for every record from offset on. For
+    # CSV the header is read first, wherever the offset is
+    counter = [offset]
+    if fmt == 'jsonl':
+        for line in _lines(f, offset, counter):
+            if line.strip():
+                yield json.loads(line), counter[0]
+        return
+    f.seek(0)
+    header = next(csv.reader([f.readline().decode('utf-8-sig')]))
+    start = max(offset, f.tell())
+    for row in csv.reader(_lines(f, start, counter)):
+        if row:
+            yield dict(zip(header, row)), counter[0]
+
+
+def to_params(records, table):
+    # (insert parameters, offset) per record, '' and missing become NULL
+    columns = IMPORT_COLUMNS[table]
+    for record, offset in records:
+        yield tuple(None if record.get(column) in ('', None) else record[column]
+                    for column in columns), offset
+
+
+def chunks(items, size):
+    iterator = iter(items)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def checkpoint_key(table, path):
+    return f'{table}:{os.path.abspath(path)}'
+
+
+def open_database(database):
+    conn = ConnectionPool(database, pragmas=BULK_PRAGMAS).connect()
+    conn.isolation_level = None  # transactions are opened by hand below
+    if conn.execute("SELECT name FROM sqlite_master WHERE name = 'transactions'").fetchone() is None:
+        raise SystemExit(f'{database} has no ledger tables, start the server once to create them')
+    migrate(conn)
+    return conn
+
+
+def import_file(conn, table, path, fmt=None, resume=False,
+                chunk_rows=CHUNK_ROWS, commit_every=COMMIT_EVERY, progress=print):
+    # load a file into a table, returns the rows imported by this run
+    key = checkpoint_key(table, path)
+    offset, done = 0, 0
+    saved = conn.execute('SELECT offset, rows FROM import_checkpoints WHERE source = ?',
+                         (key,)).fetchone()
+    if saved is not None:
+        if not resume:
+            raise SystemExit(f'{path} was imported into {table} before '
+                             '(use --resume to continue it, or --restart)')
+        offset, done = saved
+    imported = 0
+    with open(path, 'rb') as f:
+        params = to_params(read_records(f, file_format(path, fmt), offset), table)
+        for batch in chunks(chunks(params, chunk_rows), commit_every):
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                for chunk in batch:
+                    conn.executemany(INSERTS[table], (row for row, _ in chunk))
+                    imported += len(chunk)
+                offset = batch[-1][-1][1]
+                conn.execute('''INSERT INTO import_checkpoints (source, offset, rows) VALUES (?, ?, ?)
+                                ON CONFLICT (source) DO UPDATE
+                                SET offset = excluded.offset, rows = excluded.rows''',
+                             (key, offset, done + imported))
+                conn.execute('COMMIT')
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+            progress(f'{table}: {done + imported} rows imported')
+    return imported
+
+
+def forget_checkpoint(conn, table, path):
+    conn.execute('DELETE FROM import_checkpoints WHERE source = ?', (checkpoint_key(table, path),))
+
+
+def export_table(conn, table, path, fmt=None, chunk_rows=CHUNK_ROWS):
+    # write every row of a table to a file, returns the number of rows
+    fmt = file_format(path, fmt)
+    cursor = conn.execute(f'SELECT * FROM {table} ORDER BY rowid')
+    columns = [description[0] for description in cursor.description]
+    exported = 0
+    with open(path, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.writer(f) if fmt == 'csv' else None
+        if writer is not None:
+            writer.writerow(columns)
+        for rows in iter(lambda: cursor.fetchmany(chunk_rows), []):
+            if writer is not None:
+                writer.writerows(rows)
+            else:
+                f.writelines(json.dumps(dict(zip(columns, row))) + '\n' for row in rows)
+            exported += len(rows)
+    return exported
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Bulk import and export of ledger data')
+    parser.add_argument('command', choices=('import', 'export'))
+    parser.add_argument('table', choices=sorted(IMPORT_COLUMNS))
+    parser.add_argument('file')
+    parser.add_argument('--db', default='users.db')
+    parser.add_argument('--format', choices=('csv', 'jsonl'),
+                        help='default: from the file name, .jsonl/.ndjson/.json or csv')
+    parser.add_argument('--chunk', type=int, default=CHUNK_ROWS, help='rows per executemany')
+    parser.add_argument('--commit-every', type=int, default=COMMIT_EVERY,
+                        help='chunks per transaction and checkpoint')
+    parser.add_argument('--resume', action='store_true',
+                        help='continue an import from its last checkpoint')
+    parser.add_argument('--restart', action='store_true',
+                        help='forget the checkpoint and import the whole file again')
+    args = parser.parse_args()
+
+    conn = open_database(args.db)
+    try:
+        if args.command == 'export':
+            count = export_table(conn, args.table, args.file, args.format, args.chunk)
+            print(f'Exported {count} rows of {args.table} to {args.file}')
+        else:
+            if args.restart:
+                forget_checkpoint(conn, args.table, args.file)
+            count = import_file(conn, args.table, args.file, args.format, args.resume,
+                                args.chunk, args.commit_every)
+            print(f'Imported {count} rows from {args.file} into {args.table}')
+    except (OSError, ValueError, KeyError, sqlite3.Error) as e:
+        sys.exit(f'{args.command} failed: {e}')
+    finally:
+        conn.close()
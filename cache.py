@@ -0,0 +1,81 @@
+"""In-memory cache of account balances and positions
+
+AccountCache keeps {'balance', 'positions'} of recently used accounts.
+get loads an account the first time it is asked for, and the ledger
+writer calls refresh after every commit that touches one, so reads of a
+warm account never go to disk.
+
+Only changes made through the server are seen, anything that writes
+users.db behind its back leaves the cache stale.
+"""
+import threading
+from collections import OrderedDict
+
+MAX_ACCOUNTS = 10000  # accounts kept before the least recently used is dropped
+
+
+class AccountCache:
+    # Least recently used cache of {'balance': ..., 'positions': {...}}
+    def __init__(self, loader, max_accounts=MAX_ACCOUNTS):
+        # initialization of the class
+        self.loader = loader  # loader(username) -> account dict or None
+        self.max_accounts = max_accounts
+        self.accounts = OrderedDict()
+        self.lock = threading.Lock()
+        self.loading = {}  # username -> True once a commit made the load stale
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, username):
+        # the cached account, loaded from the database on a miss
+        with self.lock:
+            account = self.accounts.get(username)
+            if account is not None:
+                self.accounts.move_to_end(username)
+                self.hits += 1
+                return account
+            self.misses += 1
+            self.loading[username] = False
+        account = self.loader(username)
+        with self.lock:
+            # a commit for this account while we were loading means what
+            # we read may already be out of date, so do not keep it
+            stale = self.loading.pop(username, True)
+            if account is not None and not stale:
+                self._store(username, account)
+        return account
+
+    def refresh(self, username, load):
+        # called after a commit: reload the account if it is cached.
+        # load() reads it on the committing connection
+        with self.lock:
+            if username in self.loading:
+                self.loading[username] = True
+            if username not in self.accounts:
+                return
+        account = load()
+        with self.lock:
+            if account is None:
+                self.accounts.pop(username, None)
+            else:
+                self._store(username, account)
+
+    def invalidate(self, username):
+        with self.lock:
+            if username in self.loading:
+                self.loading[username] = True
+            self.accounts.pop(username, None)
+
+    def _store(self, username, account):
+        self.accounts[username] = account
+        self.accounts.move_to_end(username)
+        while len(self.accounts) > self.max_accounts:
+            self.accounts.popitem(last=False)
+            self.evictions += 1
+
+    def stats(self):
+        with self.lock:
+            return {'size': len(self.accounts), 'max_size': self.max_accounts,
+                    'hits': self.hits, 'misses': self.misses,
+                    'evictions': self.evictions}
@@ -2,18 +2,512 @@
 import matplotlib.pyplot as plt
 from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
 import socket
+import threading
+import itertools
+import json
+import queue
+from concurrent.futures import ThreadPoolExecutor
 import tkinter as tk
 from tkinter import messagebox
-import sqlite3
 from tkinter import ttk
 import matplotlib
+import numpy as np
 import pandas as pd
+from market_data import market_data
+from protocol import (send_frame, recv_frame, make_request, split_response,
+                      ProtocolError)
 matplotlib.use('TkAgg')
 
 # Defining the Host and Port to make connection
 HOST = '127.0.0.1'
 PORT = 8000
 
+# How often (ms) an open PortfolioWindow checks for pushed price updates
+STREAM_POLL_MS = 250
+# How often (ms) finished server requests are picked up, about once a frame
+REQUEST_POLL_MS = 16
+# Market tables with more rows than this only create the visible items
+VIRTUAL_ROWS = 1000
+ROW_HEIGHT = 20  # pixels, the default Treeview row height
+# Redraw requests closer together than this (ms) are merged into one
+REDRAW_DELAY_MS = 50
+# Transactions asked for at a time by the history window
+TRANSACTION_PAGE = 100
+# Requests that change nothing on the server, so sending one twice is harmless
+READ_ONLY_ACTIONS = frozenset([
+    'login', 'get_balance', 'get_portfolio', 'get_valuation', 'revalue', 'cache_stats',
+    'get_transactions', 'get_quotes', 'get_history', 'refresh_status'])
+
+
+class ServerConnection:
+    # One connection to the server shared by every window of a session.
+    # It is opened on first use, kept open between requests and reopened
+    # when the server has dropped it, so windows never pay for a new
+    # handshake per request. A request that may already have reached the
+    # server is only sent again if it is read only, so a deposit or trade
+    # is never applied twice.
+    def __init__(self, host=HOST, port=PORT, timeout=10):
+        # initialization of the class
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.sock = None
+        self.lock = threading.Lock()  # one request at a time on the socket
+        self.request_ids = itertools.count(1)
+
+    def connect(self):
+        self.sock = socket.create_connection(
+            (self.host, self.port), timeout=self.timeout)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def close(self):
+        if self.sock is not None:
+            try:
+                self.sock.close()
+            finally:
+                self.sock = None
+
+    def request(self, action, *args):
+        # send one request and wait for the response with the same id
+        return self._exchange(action, args, streamed=False)
+
+    def request_stream(self, action, *args):
+        # send one request whose answer comes as several JSON parts with
+        # the same id, each saying whether 'more' follow; returns them all.
+        # Raises ValueError with the server's text if it answers otherwise
+        return self._exchange(action, args, streamed=True)
+
+    def _exchange(self, action, args, streamed):
+        with self.lock:
+            while True:
+                reused = self.sock is not None
+                if not reused:
+                    self.connect()
+                request_id = str(next(self.request_ids))
+                sent = False
+                try:
+                    send_frame(self.sock, make_request(
+                        request_id, action, *args))
+                    sent = True
+                    parts = []
+                    while True:
+                        text = recv_frame(self.sock)
+                        if text is None:
+                            raise ConnectionError(
+                                'Server closed the connection')
+                        response_id, response = split_response(text)
+                        if response_id != request_id:
+                            continue
+                        if not streamed:
+                            return response
+                        if not response.startswith('{'):
+                            raise ValueError(response)
+                        parts.append(json.loads(response))
+                        if not parts[-1]['more']:
+                            return parts
+                except (OSError, ProtocolError) as e:
+                    self.close()
+                    # a kept-open connection may have gone stale (e.g. the
+                    # server restarted), try once more on a fresh one. A
+                    # timeout is a slow server, not a stale connection
+                    if not reused or isinstance(e, socket.timeout) or \
+                            (sent and action not in READ_ONLY_ACTIONS):
+                        raise
+
+
+class QuoteBook:
+    # The session's copy of the server's quotes. Each refresh only asks for
+    # what changed since the version we already have
+    COLUMNS = {
+        'Stocks': ('Last Price', 'last_trade_time', 'Last Trade Time'),
+        'Cryptocurrency': ('Price', 'market_cap', 'Market Cap'),
+    }
+
+    def __init__(self, server):
+        # initialization of the class
+        self.server = server
+        self.version = 0
+        self.quotes = {}  # symbol -> quote
+
+    def refresh(self):
+        self.apply(self.fetch())
+
+    def fetch(self):
+        # what changed on the server since our version, safe to call off
+        # the Tk thread as long as apply() runs on it
+        return json.loads(self.server.request('get_quotes', self.version))
+
+    def apply(self, snapshot):
+        # merge a get_quotes answer or a subscription update
+        self.quotes.update(snapshot['quotes'])
+        for symbol in snapshot['removed']:
+            self.quotes.pop(symbol, None)
+        self.version = max(self.version, snapshot['version'])
+
+    def frame(self, market):
+        # the market's quotes with the same columns the CSV files have
+        price_column, extra_key, extra_column = self.COLUMNS[market]
+        quotes = [quote for quote in self.quotes.values()
+                  if quote['market'] == market]
+        return pd.DataFrame({
+            'Name': [quote['symbol'] for quote in quotes],
+            extra_column: [quote.get(extra_key) for quote in quotes],
+            price_column: [quote['price'] for quote in quotes],
+        })
+
+
+class MarketTable:
+    # Keeps a market Treeview in step with a DataFrame of quotes. Prices are
+    # formatted a column at a time and only items whose values changed are
+    # touched. In virtual mode only the rows that fit in the widget exist as
+    # items, and the scrollbar moves that window over the data instead of
+    # scrolling the Treeview
+    def __init__(self, tree, scrollbar, virtual=None, virtual_rows=VIRTUAL_ROWS):
+        # initialization of the class
+        self.tree = tree
+        self.scrollbar = scrollbar
+        self.virtual = virtual  # None: only with more than virtual_rows rows
+        self.virtual_rows = virtual_rows
+        self.rows = []  # (iid, values) of every row, in display order
+        self.shown = {}  # iid -> values of the items in the Treeview
+        self.scrolling_virtually = None
+        self.top = 0  # index of the first row shown in virtual mode
+        tree.bind('<Configure>', self.on_resize, add='+')
+        for sequence in ('<MouseWheel>', '<Button-4>', '<Button-5>'):
+            tree.bind(sequence, self.on_wheel, add='+')
+
+    @staticmethod
+    def format_rows(dataframe, market_type):
+        # (iid, (market, quantity, amount)) per row, the symbol is the iid
+        price_column = QuoteBook.COLUMNS[market_type][0]
+        names = dataframe['Name'].astype(str).tolist()
+        prices = pd.to_numeric(dataframe[price_column], errors='coerce')
+        amounts = np.char.mod('$%.2f', prices.to_numpy(dtype=float)).tolist()
+        return [(name, (name, '1', amount)) for name, amount in zip(names, amounts)]
+
+    def show(self, dataframe, market_type):
+        # a symbol listed twice keeps its last row, like the quote book
+        self.rows = list(dict(self.format_rows(dataframe, market_type)).items())
+        virtual = self.virtual
+        if virtual is None:
+            virtual = len(self.rows) > self.virtual_rows
+        if virtual != self.scrolling_virtually:
+            self.tree.delete(*self.shown)
+            self.shown = {}
+            self.scrolling_virtually = virtual
+            if virtual:
+                self.tree.configure(yscrollcommand='')
+                self.scrollbar.configure(command=self.yview)
+            else:
+                self.tree.configure(yscrollcommand=self.scrollbar.set)
+                self.scrollbar.configure(command=self.tree.yview)
+        self.render()
+
+    def render(self):
+        if not self.scrolling_virtually:
+            self._sync(self.rows)
+            return
+        visible = self.visible_rows()
+        self.top = max(0, min(self.top, len(self.rows) - visible))
+        self._sync(self.rows[self.top:self.top + visible])
+        if self.rows:
+            self.scrollbar.set(self.top / len(self.rows),
+                               min(1.0, (self.top + visible) / len(self.rows)))
+        else:
+            self.scrollbar.set(0.0, 1.0)
+
+    def _sync(self, rows):
+        # make the Treeview items exactly rows, in order
+        wanted = dict(rows)
+        gone = [iid for iid in self.shown if iid not in wanted]
+        if gone:
+            self.tree.delete(*gone)
+        for iid, values in rows:
+            old = self.shown.get(iid)
+            if old is None:
+                self.tree.insert('', 'end', iid=iid, values=values)
+            elif old != values:
+                self.tree.item(iid, values=values)
+        self.shown = wanted
+        order = tuple(wanted)
+        if self.tree.get_children() != order:
+            for index, iid in enumerate(order):
+                self.tree.move(iid, '', index)
+
+    def visible_rows(self):
+        return max(int(self.tree.cget('height')),
+                   self.tree.winfo_height() // ROW_HEIGHT)
+
+    def yview(self, *args):
+        # scrollbar command in virtual mode: moveto fraction, or
+        # scroll n units|pages
+        if args[0] == 'moveto':
+            self.top = int(float(args[1]) * len(self.rows))
+        elif args[0] == 'scroll':
+            step = self.visible_rows() if args[2] == 'pages' else 1
+            self.top += int(args[1]) * step
+        self.render()
+
+    def on_resize(self, event):
+        if self.scrolling_virtually:
+            self.render()
+
+    def on_wheel(self, event):
+        if not self.scrolling_virtually:
+            return None  # the Treeview scrolls itself
+        self.yview('scroll', -3 if event.num == 4 or event.delta > 0 else 3, 'units')
+        return 'break'
+
+
+class MarketChart:
+    # Draws one market's prices on an Axes. The line or bars are built once
+    # per market and list of symbols; after that a price update only sets
+    # their data and blits them over the saved background, instead of
+    # clearing the Axes and drawing the whole figure again
+    STYLES = {
+        'Stocks': ('line', 'Top 10 Stock Prices', 'Stock', 'Last Price'),
+        'Cryptocurrency': ('bar', 'Cryptocurrency Prices', 'Name', 'Price'),
+    }
+
+    def __init__(self, canvas, ax):
+        # initialization of the class
+        self.canvas = canvas
+        self.ax = ax
+        self.market = None
+        self.names = None
+        self.artists = []  # animated, so full draws leave them out
+        self.background = None  # the Axes without the artists
+        self.full_draws = 0
+        self.blits = 0
+        canvas.mpl_connect('draw_event', self.on_draw)
+
+    def show(self, market, names, prices):
+        names = list(names)
+        prices = np.asarray(prices, dtype=float)
+        if market != self.market or names != self.names or not self._fits(prices):
+            self._build(market, names, prices)
+        else:
+            self._update(prices)
+
+    def _fits(self, prices):
+        # whether the prices stay inside the current y axis
+        bottom, top = self.ax.get_ylim()
+        prices = prices[np.isfinite(prices)]
+        return prices.size == 0 or (prices.min() >= bottom and prices.max() <= top)
+
+    def _build(self, market, names, prices):
+        kind, title, xlabel, ylabel = self.STYLES[market]
+        self.ax.clear()
+        if kind == 'line':
+            # Use ax.plot for a line graph instead of ax.bar
+            self.artists = self.ax.plot(names, prices, color='skyblue', marker='o',
+                                        linestyle='-', linewidth=2, animated=True)
+        else:
+            self.artists = list(self.ax.bar(names, prices, color='skyblue', animated=True))
+        self.ax.set_title(title)
+        self.ax.set_xlabel(xlabel)
+        self.ax.set_ylabel(ylabel)
+        self.ax.tick_params(axis='x', rotation=45)
+        self.market = market
+        self.names = names
+        self.ax.figure.tight_layout()
+        self.full_draws += 1
+        self.canvas.draw()  # on_draw saves the background and adds the artists
+
+    def _update(self, prices):
+        if self.STYLES[self.market][0] == 'line':
+            self.artists[0].set_ydata(prices)
+        else:
+            for bar, price in zip(self.artists, prices):
+                bar.set_height(price)
+        if self.background is None:
+            self.canvas.draw_idle()
+            return
+        self.canvas.restore_region(self.background)
+        self._draw_artists()
+        self.canvas.blit(self.ax.bbox)
+        self.blits += 1
+
+    def on_draw(self, event):
+        # after every full draw, e.g. a resize, keep the new background
+        self.background = self.canvas.copy_from_bbox(self.ax.bbox)
+        self._draw_artists()
+
+    def _draw_artists(self):
+        for artist in self.artists:
+            self.ax.draw_artist(artist)
+
+
+class RequestCall:
+    # One request handed to a RequestRunner
+    def __init__(self, owner, func, args, on_done, on_error):
+        # initialization of the class
+        self.owner = owner
+        self.func = func
+        self.args = args
+        self.on_done = on_done
+        self.on_error = on_error
+        self.cancelled = False
+
+    def cancel(self):
+        # the callbacks will not run, a request already sent still finishes
+        self.cancelled = True
+
+
+class RequestRunner:
+    # Runs server requests on a worker thread so a slow server never
+    # freezes the windows. Results are picked up on the Tk thread with
+    # after() and handed to the caller's on_done/on_error there. A window
+    # shows a busy cursor while it has requests in flight, and its pending
+    # requests are cancelled when it is destroyed.
+    def __init__(self, root, server):
+        # initialization of the class
+        self.root = root
+        self.server = server
+        # one worker, the connection only carries one request at a time
+        self.executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix='server-request')
+        self.finished = queue.SimpleQueue()
+        self.in_flight = {}  # owner -> calls not finished yet
+        self.watched = set()  # owners whose <Destroy> we listen to
+        self.poll_id = None
+
+    def request(self, owner, action, *args, on_done=None, on_error=None):
+        # send action|args... and call on_done(response) when it arrives
+        return self.submit(owner, self.server.request, action, *args,
+                           on_done=on_done, on_error=on_error)
+
+    def submit(self, owner, func, *args, on_done=None, on_error=None):
+        # run func(*args) on the worker, on_error(exception) if it raises;
+        # without on_error the error is shown in a message box
+        call = RequestCall(owner, func, args, on_done, on_error)
+        if owner not in self.watched:
+            self.watched.add(owner)
+            owner.bind('<Destroy>', lambda event: self._destroyed(
+                event, owner), add='+')
+        if owner not in self.in_flight:
+            self.in_flight[owner] = []
+            owner.config(cursor='watch')
+        self.in_flight[owner].append(call)
+        self.executor.submit(self._run, call)
+        if self.poll_id is None:
+            self.poll_id = self.root.after(REQUEST_POLL_MS, self._poll)
+        return call
+
+    def cancel(self, owner):
+        # drop every pending request of a window, e.g. when it closes
+        calls = self.in_flight.pop(owner, [])
+        for call in calls:
+            call.cancel()
+        if calls:
+            self._idle(owner)
+
+    def busy(self, owner):
+        return bool(self.in_flight.get(owner))
+
+    def close(self):
+        for owner in list(self.in_flight):
+            self.cancel(owner)
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        if self.poll_id is not None:
+            self.root.after_cancel(self.poll_id)
+            self.poll_id = None
+
+    def _run(self, call):
+        # worker thread: never touches Tk, only queues the outcome
+        if call.cancelled:
+            return
+        try:
+            self.finished.put((call, call.func(*call.args), None))
+        except Exception as e:
+            self.finished.put((call, None, e))
+
+    def _poll(self):
+        self.poll_id = None
+        while not self.finished.empty():
+            call, result, error = self.finished.get()
+            self._forget(call)
+            if call.cancelled:
+                continue
+            if error is None:
+                if call.on_done is not None:
+                    call.on_done(result)
+            elif call.on_error is not None:
+                call.on_error(error)
+            else:
+                messagebox.showerror(
+                    "Server Error", str(error), parent=call.owner)
+        if self.in_flight:
+            self.poll_id = self.root.after(REQUEST_POLL_MS, self._poll)
+
+    def _forget(self, call):
+        calls = self.in_flight.get(call.owner)
+        if calls is None or call not in calls:
+            return
+        calls.remove(call)
+        if not calls:
+            del self.in_flight[call.owner]
+            self._idle(call.owner)
+
+    def _idle(self, owner):
+        try:
+            owner.config(cursor='')
+        except tk.TclError:
+            pass  # the window is already gone
+
+    def _destroyed(self, event, owner):
+        if event.widget is owner:
+            self.watched.discard(owner)
+            self.cancel(owner)
+
+
+class QuoteStream(threading.Thread):
+    # Keeps a subscribe connection open in the background and queues every
+    # price update it receives until the Tk thread picks them up
+    def __init__(self, host=HOST, port=PORT, symbols=()):
+        # initialization of the class
+        super().__init__(name='quote-stream', daemon=True)
+        self.host = host
+        self.port = port
+        self.symbols = symbols
+        self.updates = queue.SimpleQueue()
+        self.stopped = threading.Event()
+        self.sock = None
+
+    def run(self):
+        try:
+            self.sock = socket.create_connection((self.host, self.port))
+            if self.stopped.is_set():
+                return
+            send_frame(self.sock, make_request(
+                'quotes', 'subscribe', *self.symbols))
+            while not self.stopped.is_set():
+                text = recv_frame(self.sock)
+                if text is None:
+                    break
+                self.updates.put(json.loads(split_response(text)[1]))
+        except (OSError, ProtocolError, ValueError) as e:
+            if not self.stopped.is_set():
+                print("Price updates stopped:", e)
+        finally:
+            if self.sock is not None:
+                self.sock.close()
+
+    def stop(self):
+        self.stopped.set()
+        if self.sock is not None:
+            try:
+                self.sock.shutdown(socket.SHUT_RDWR)  # wakes up recv
+            except OSError:
+                pass
+
+    def drain(self):
+        # every update received since the last call
+        updates = []
+        while not self.updates.empty():
+            updates.append(self.updates.get())
+        return updates
+
 
 class CenteredTkWindow:
     # Class to center all the screen window
@@ -55,6 +549,9 @@ class MainWindow(tk.Tk, CenteredTkWindow):
     def __init__(self):
         # initialization of the class
         super(MainWindow, self).__init__()
+        self.server = ServerConnection()  # shared by every window
+        self.quotes = QuoteBook(self.server)
+        self.requests = RequestRunner(self, self.server)  # off the Tk thread
         self.title("User Login")  # Title of the window
         self.geometry("500x500")  # window size
         self.center_window()  # calling center window
@@ -85,11 +582,11 @@ class MainWindow(tk.Tk, CenteredTkWindow):
         # perform this function when user tries to login
         username = self.username_entry.get()  # Get user input
         password = self.password_entry.get()
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-            s.connect((HOST, PORT))
-            request = f'login|{username}|{password}'
-            s.sendall(request.encode())  # S - TCP Socket - send data to server
-            response = s.recv(1024).decode()
+        self.requests.request(self, 'login', username, password,
+                              on_done=lambda response: self.logged_in(username, response))
+
+    def logged_in(self, username, response):
+        # the server's answer to login, back on the Tk thread
         if response.startswith('Login successful'):
             client_id = response.split(': ')[-1]  # Correctly extract client ID
             self.withdraw()  # Hide the login window
@@ -101,6 +598,8 @@ class MainWindow(tk.Tk, CenteredTkWindow):
         RegisterWindow(self)
 
     def on_closing(self):
+        self.requests.close()
+        self.server.close()
         self.quit()  # after register this window will close it self
 
 
@@ -109,6 +608,8 @@ class RegisterWindow(tk.Toplevel, CenteredTkWindow):
     def __init__(self, parent):
         # initialization of the class
         super().__init__(parent)
+        self.server = parent.server
+        self.requests = parent.requests
         self.title("Register")
         self.geometry("500x500")
         self.center_window()
@@ -143,13 +644,11 @@ class RegisterWindow(tk.Toplevel, CenteredTkWindow):
                 "Error", "Username must be at least 4 characters and password must be at least 6 characters")
             return
 
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-            # send data to server of newly register user
-            s.connect((HOST, PORT))
-            request = f'register|{username}|{password}'
-            s.sendall(request.encode())
-            response = s.recv(1024).decode()
+        # send data to server of newly register user
+        self.requests.request(self, 'register', username, password,
+                              on_done=self.registered)
 
+    def registered(self, response):
         messagebox.showinfo("Registration Result", response)
         self.destroy()
         self.master.deiconify()
@@ -160,6 +659,9 @@ class AccountWindow(tk.Toplevel, CenteredTkWindow):
     def __init__(self, parent, username, client_id):
         # initialization of the class
         super().__init__(parent)
+        self.server = parent.server
+        self.quotes = parent.quotes
+        self.requests = parent.requests
         self.client_id = client_id
         self.username = username
         self.title(f"{username}'s Account")
@@ -196,6 +698,10 @@ class AccountWindow(tk.Toplevel, CenteredTkWindow):
             self, text="Portfolio Viewing", command=self.open_portfolio)
         portfolio_button.pack(pady=5)
 
+        transactions_button = tk.Button(
+            self, text="Transaction History", command=self.open_transactions)
+        transactions_button.pack(pady=5)
+
         self.request_update_balance()
 
     def deposit_money(self):
@@ -205,17 +711,8 @@ class AccountWindow(tk.Toplevel, CenteredTkWindow):
             amount = float(amount_str)
             if amount <= 0:
                 raise ValueError("Amount must be positive")
-            conn = sqlite3.connect('users.db')
-            c = conn.cursor()
-            c.execute(
-                "UPDATE users SET balance = balance + ? WHERE username = ?", (amount, self.username))
-            c.execute(
-                "INSERT INTO transactions (username, transaction_type, amount) VALUES (?, 'deposit', ?)", (self.username, amount))
-            conn.commit()
-            conn.close()
-            messagebox.showinfo(
-                "Deposit Successful", f"${amount} has been deposited to your balance.")
-            self.request_update_balance()
+            self._update_balance(
+                amount, "Deposit Successful", f"${amount} has been deposited to your balance.")
         except ValueError as e:
             messagebox.showerror("Error", str(e))
 
@@ -226,44 +723,28 @@ class AccountWindow(tk.Toplevel, CenteredTkWindow):
             amount = float(amount_str)
             if amount <= 0:
                 raise ValueError("Amount must be positive")
-            conn = sqlite3.connect('users.db')
-            c = conn.cursor()
-            c.execute("SELECT balance FROM users WHERE username = ?",
-                      (self.username,))
-            balance = c.fetchone()[0]
-            if balance < amount:
-                raise ValueError("Insufficient funds")
-            c.execute(
-                "UPDATE users SET balance = balance - ? WHERE username = ?", (amount, self.username))
-            c.execute(
-                "INSERT INTO transactions (username, transaction_type, amount) VALUES (?, 'withdraw', ?)", (self.username, amount))
-            conn.commit()
-            conn.close()
-            messagebox.showinfo(
-                "Withdrawal Successful", f"${amount} has been withdrawn from your balance.")
-            self.request_update_balance()
+            self._update_balance(
+                -amount, "Withdrawal Successful", f"${amount} has been withdrawn from your balance.")
         except ValueError as e:
             messagebox.showerror("Error", str(e))
 
-    def _update_balance(self, amount_change):
-        """Updates the user's balance in the database and records the transaction."""
-        conn = sqlite3.connect('users.db')
-        c = conn.cursor()
+    def _update_balance(self, amount_change, title, message):
+        """Asks the server to change the balance, it records the transaction.
+        Shows title/message once it is done, the server's answer if not."""
         if amount_change > 0:
-            transaction_type = 'deposit'
+            action, expected = 'deposit', 'Deposit successful.'
         else:
-            transaction_type = 'withdraw'
-            amount_change = -amount_change
-        try:
-            c.execute("UPDATE users SET balance = balance + ? WHERE username = ?",
-                      (amount_change, self.username))
-            c.execute("INSERT INTO transactions (username, transaction_type, amount) VALUES (?, ?, ?)",
-                      (self.username, transaction_type, amount_change))
-            conn.commit()
-        except sqlite3.Error as e:
-            messagebox.showerror("Database Error", str(e))
-        finally:
-            conn.close()
+            action, expected = 'withdraw', 'Withdrawal successful'
+        self.requests.request(
+            self, action, self.username, abs(amount_change),
+            on_done=lambda response: self._balance_updated(response, expected, title, message))
+
+    def _balance_updated(self, response, expected, title, message):
+        if response != expected:
+            messagebox.showerror("Error", response, parent=self)
+            return
+        messagebox.showinfo(title, message, parent=self)
+        self.request_update_balance()
 
     def update_balance_display(self):
         """Updates the balance label with the latest balance."""
@@ -272,28 +753,33 @@ class AccountWindow(tk.Toplevel, CenteredTkWindow):
 
     def request_update_balance(self):
         # Fucntion to resquest balance from server side
-        request = f'get_balance|{self.username}'
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-            s.connect((HOST, PORT))
-            s.sendall(request.encode())
-            response = s.recv(1024).decode()
-            try:
-                balance = float(response)
-                self.portfolio['balance'] = balance
-                self.update_balance_display()
-            except ValueError:
-                print("Error fetching balance:", response)
+        self.requests.request(self, 'get_balance', self.username,
+                              on_done=self.show_balance)
+
+    def show_balance(self, response):
+        try:
+            balance = float(response)
+            self.portfolio['balance'] = balance
+            self.update_balance_display()
+        except ValueError:
+            print("Error fetching balance:", response)
 
     def open_portfolio(self):
         PortfolioWindow(self, self.username, self.client_id,
                         self.portfolio['balance'])
 
+    def open_transactions(self):
+        TransactionsWindow(self, self.username)
+
 
 class PortfolioWindow(tk.Toplevel, CenteredTkWindow):
     # Class for the Portfolio Window
     def __init__(self, parent, username, client_id, balance):
         # initialization of the class
         super().__init__(parent)
+        self.server = parent.server
+        self.quotes = parent.quotes
+        self.requests = parent.requests
         self.username = username
         self.client_id = client_id
         self.balance = balance
@@ -309,9 +795,32 @@ class PortfolioWindow(tk.Toplevel, CenteredTkWindow):
         }
 
         self.investment_option.set('Stocks')
+        self.graph_id = None  # pending update_graph, see there
         self.create_widgets()
         self.update_graph()
 
+        # live prices pushed by the server while the window is open
+        self.stream = QuoteStream(self.server.host, self.server.port)
+        self.stream.start()
+        self.poll_id = self.after(STREAM_POLL_MS, self.poll_quotes)
+        self.bind('<Destroy>', self.on_destroy, add='+')
+
+    def poll_quotes(self):
+        # pick up pushed prices on the Tk thread and redraw if any came in
+        updates = self.stream.drain()
+        for update in updates:
+            self.quotes.apply(update)
+        if updates:
+            self.draw_graph()
+        self.poll_id = self.after(STREAM_POLL_MS, self.poll_quotes)
+
+    def on_destroy(self, event):
+        if event.widget is self:
+            self.after_cancel(self.poll_id)
+            if self.graph_id is not None:
+                self.after_cancel(self.graph_id)
+            self.stream.stop()
+
     def create_widgets(self):
         """ GUI components - Button, Input Block, Labels"""
         client_id_label = tk.Label(self, text=f"Client ID: {self.client_id}")
@@ -337,7 +846,10 @@ class PortfolioWindow(tk.Toplevel, CenteredTkWindow):
         self.tree.column('Quantity', anchor='center')
         self.tree.column('Amount', anchor='center')
 
+        tree_scrollbar = ttk.Scrollbar(grid_frame, orient='vertical')
+        tree_scrollbar.pack(side='right', fill='y')
         self.tree.pack(fill='both', expand=True)
+        self.table = MarketTable(self.tree, tree_scrollbar)
 
         chart_frame = tk.Frame(main_frame)
         chart_frame.pack(side='right', fill='both', expand=True)
@@ -346,6 +858,7 @@ class PortfolioWindow(tk.Toplevel, CenteredTkWindow):
         self.canvas = FigureCanvasTkAgg(self.fig, master=chart_frame)
         self.canvas.draw()
         self.canvas.get_tk_widget().pack(side='top', fill='both', expand=True)
+        self.chart = MarketChart(self.canvas, self.ax)
 
         invest_frame = tk.Frame(self)
         invest_frame.pack(pady=10)
@@ -358,8 +871,8 @@ class PortfolioWindow(tk.Toplevel, CenteredTkWindow):
         self.investment_option.set('Stocks')
 
         investment_menu = tk.OptionMenu(
-            self, self.investment_option, *self.market_files.keys(), command=self.update_graph
-        )
+            self, self.investment_option, *self.market_files.keys()
+        )  # the trace below redraws, a command here would redraw twice
         investment_menu.pack(pady=10)
 
         my_investment_button = tk.Button(
@@ -370,16 +883,15 @@ class PortfolioWindow(tk.Toplevel, CenteredTkWindow):
         self.request_update_balance()
 
     def request_update_balance(self):
-        request = f'get_balance|{self.username}'
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-            s.connect((HOST, PORT))
-            s.sendall(request.encode())
-            response = s.recv(1024).decode()
-            try:
-                balance = float(response)
-                self.portfolio['balance'] = balance
-            except ValueError:
-                print("Error fetching balance:", response)
+        self.requests.request(self, 'get_balance', self.username,
+                              on_done=self.show_balance)
+
+    def show_balance(self, response):
+        try:
+            balance = float(response)
+            self.portfolio['balance'] = balance
+        except ValueError:
+            print("Error fetching balance:", response)
 
     def update_balance_display(self):
         self.portfolio['balance'] = self.balance
@@ -422,23 +934,39 @@ class PortfolioWindow(tk.Toplevel, CenteredTkWindow):
 
     def populate_treeview(self, dataframe, market_type):
         """ GUI components - Trss, Labels"""
-        for item in self.tree.get_children():
-            self.tree.delete(item)
+        self.table.show(dataframe, market_type)
 
-        for index, row in dataframe.iterrows():
-            market_name = row['Name']
-            quantity = "1"
-            if market_type == 'Stocks':
-                amount = f"${row['Last Price']:.2f}"
-                market_display_name = market_name
-            elif market_type == 'Cryptocurrency':
-                amount = f"${row['Price']:.2f}"
-                market_display_name = market_name
+    def update_graph(self, *args):
+        # fetch the latest prices off the Tk thread, then redraw. Calls that
+        # come in together (e.g. one market switch) only fetch once
+        if self.graph_id is None:
+            self.graph_id = self.after(REDRAW_DELAY_MS, self._update_graph)
+
+    def _update_graph(self):
+        self.graph_id = None
+        self.requests.submit(self, self.quotes.fetch, on_done=self.show_quotes,
+                             on_error=self.show_saved_quotes)
+
+    def show_saved_quotes(self, error):
+        # the server could not be asked, draw what we have or the files
+        print("Error fetching quotes:", error)
+        self.draw_graph()
+
+    def market_frame(self, market):
+        # the server's quotes, or the last saved scrape while it has none
+        frame = self.quotes.frame(market)
+        if frame.empty:
+            try:
+                frame = market_data.load(self.market_files[market], market)
+            except OSError:
+                pass
+        return frame
 
-            self.tree.insert('', 'end', values=(
-                market_display_name, quantity, amount))
+    def show_quotes(self, snapshot):
+        self.quotes.apply(snapshot)
+        self.draw_graph()
 
-    def update_graph(self, *args):
+    def draw_graph(self):
         selected_market = self.investment_option.get()
         if selected_market == 'Stocks':
             self.plot_stock_data()
@@ -450,54 +978,35 @@ class PortfolioWindow(tk.Toplevel, CenteredTkWindow):
     def plot_stock_data(self):
         """ GUI components - To plot stock graph"""
         try:
-            stocks_df = pd.read_csv('stocks.csv')
+            stocks_df = self.market_frame('Stocks')
             if not stocks_df.empty:
-                self.ax.clear()
-                # Use ax.plot for a line graph instead of ax.bar
-                self.ax.plot(stocks_df['Name'], stocks_df['Last Price'],
-                             color='skyblue', marker='o', linestyle='-', linewidth=2)
-                self.ax.set_title('Top 10 Stock Prices')
-                self.ax.set_xlabel('Stock')
-                self.ax.set_ylabel('Last Price')
-                self.ax.tick_params(axis='x', rotation=45)
-                plt.tight_layout()
-                self.canvas.draw()
+                self.chart.show('Stocks', stocks_df['Name'], stocks_df['Last Price'])
                 self.populate_treeview(stocks_df, 'Stocks')  # Update Treeview
             else:
-                print("Stock data file is empty or not found.")
+                print("No stock prices on the server yet.")
         except Exception as e:
             print(f"Error loading or plotting stock data: {e}")
 
     def plot_crypto_data(self):
         """ GUI components - To plot crypto graph"""
         try:
-            cryptos_df = pd.read_csv('cryptocurrencies.csv')
+            cryptos_df = self.market_frame('Cryptocurrency')
             if not cryptos_df.empty:
-                cryptos_df['Price'] = cryptos_df['Price'].replace(
-                    '[\$,]', '', regex=True).astype(float)
-                self.plot_data(cryptos_df, 'Cryptocurrency Prices')
+                self.chart.show('Cryptocurrency', cryptos_df['Name'], cryptos_df['Price'])
                 self.populate_treeview(
                     cryptos_df, 'Cryptocurrency')  # Update Treeview
             else:
-                print("Cryptocurrency data file is empty or not found.")
+                print("No cryptocurrency prices on the server yet.")
         except Exception as e:
             print(f"Error loading or plotting cryptocurrency data: {e}")
 
-    def plot_data(self, df, title):
-        self.ax.clear()
-        self.ax.bar(df['Name'], df['Price'], color='skyblue')
-        self.ax.set_title(title)
-        self.ax.set_xlabel('Name')
-        self.ax.set_ylabel('Price')
-        self.ax.tick_params(axis='x', rotation=45)
-        plt.tight_layout()
-        self.canvas.draw()
-
 
 class Investment(tk.Toplevel, CenteredTkWindow):
     def __init__(self, parent, username, selected_market, item_price):
         # initialization of the class
         super().__init__(parent)
+        self.server = parent.server
+        self.requests = parent.requests
         self.username = username
         self.selected_market = selected_market
         self.item_price = item_price  # Store the price
@@ -541,8 +1050,9 @@ class Investment(tk.Toplevel, CenteredTkWindow):
         tk.Radiobutton(trade_option_frame, text="Sell",
                        variable=self.trade_option, value="Sell").pack(side='left', padx=5)
 
-        tk.Button(self, text="Confirm",
-                  command=self.confirm_investment).pack(pady=10)
+        self.confirm_button = tk.Button(self, text="Confirm",
+                                        command=self.confirm_investment)
+        self.confirm_button.pack(pady=10)
         tk.Button(self, text="Cancel", command=self.destroy).pack(pady=10)
 
     def update_investment_amount(self, event=None):
@@ -562,68 +1072,46 @@ class Investment(tk.Toplevel, CenteredTkWindow):
 
         total_amount = item_price * quantity
 
-        conn = sqlite3.connect('users.db')
-        c = conn.cursor()
+        self.confirm_button.config(state='disabled')  # until the server answers
+        self.requests.submit(
+            self, self.send_trade, transaction_type, username, selected_market,
+            quantity, total_amount,
+            on_done=self.trade_done, on_error=self.trade_failed)
 
+    def send_trade(self, transaction_type, username, selected_market, quantity, total_amount):
+        # runs on the request worker: the server owns the database, it checks
+        # the balance or position and prices the trade from its latest quotes
         if transaction_type == "Buy":
-            c.execute("SELECT balance FROM users WHERE username=?", (username,))
-            balance = c.fetchone()[0]
-            if balance < total_amount:
-                messagebox.showerror("Error", "Insufficient funds")
-                return
-            else:
-                c.execute(
-                    "UPDATE users SET balance = balance - ? WHERE username=?", (total_amount, username))
-                c.execute("INSERT INTO transactions (username, transaction_type, amount, market) VALUES (?, ?, ?, ?)",
-                          (username, 'buy', total_amount, selected_market))
-                # Check if the user already owns part of the market
-                c.execute("SELECT quantity FROM portfolios WHERE username=? AND market=?",
-                          (username, selected_market))
-                row = c.fetchone()
-                if row:
-                    new_quantity = row[0] + quantity
-                    c.execute("UPDATE portfolios SET quantity=? WHERE username=? AND market=?",
-                              (new_quantity, username, selected_market))
-                else:
-                    c.execute("INSERT INTO portfolios (username, market, quantity, amount) VALUES (?, ?, ?, ?)",
-                              (username, selected_market, quantity, total_amount))
+            response = self.server.request(
+                'invest', username, selected_market, quantity, total_amount, 'buy')
+            if response != 'Investment successful':
+                raise ValueError(response)
         elif transaction_type == "Sell":
-            c.execute("SELECT quantity FROM portfolios WHERE username=? AND market=?",
-                      (username, selected_market))
-            row = c.fetchone()
-            if row and row[0] >= quantity:
-                c.execute(
-                    "UPDATE users SET balance = balance + ? WHERE username=?", (total_amount, username))
-                c.execute("INSERT INTO transactions (username, transaction_type, amount, market) VALUES (?, ?, ?, ?)",
-                          (username, 'sell', total_amount, selected_market))
-                new_quantity = row[0] - quantity
-                if new_quantity > 0:
-                    c.execute("UPDATE portfolios SET quantity=? WHERE username=? AND market=?",
-                              (new_quantity, username, selected_market))
-                else:
-                    c.execute(
-                        "DELETE FROM portfolios WHERE username=? AND market=?", (username, selected_market))
-            else:
-                messagebox.showerror(
-                    "Error", "You do not own enough of this item to sell")
-                conn.close()
-                return
+            result = json.loads(self.server.request(
+                'sell_stock', username, selected_market, quantity))
+            if result['status'] != 'success':
+                raise ValueError(result['message'])
         else:
-            messagebox.showerror("Error", "Invalid transaction type")
-            conn.close()
-            return
+            raise ValueError("Invalid transaction type")
+        return transaction_type
 
-        conn.commit()
-        conn.close()
+    def trade_done(self, transaction_type):
         messagebox.showinfo(
-            "Transaction Complete", f"Your {transaction_type} transaction has been processed.")
+            "Transaction Complete", f"Your {transaction_type} transaction has been processed.",
+            parent=self)
         self.destroy()
 
+    def trade_failed(self, error):
+        messagebox.showerror("Error", str(error), parent=self)
+        self.confirm_button.config(state='normal')
+
 
 class MyInvestmentWindow(tk.Toplevel, CenteredTkWindow):
     # initialization of the class
     def __init__(self, parent, username):
         super().__init__(parent)
+        self.server = parent.server
+        self.requests = parent.requests
         self.username = username
         self.title(f"{username}'s Investments")
         self.geometry("600x400")
@@ -634,28 +1122,143 @@ class MyInvestmentWindow(tk.Toplevel, CenteredTkWindow):
     def create_widgets(self):
         """ GUI components - Button, Input Block, Labels"""
         self.tree = ttk.Treeview(self, columns=(
-            'Market', 'Quantity', 'Amount'), show='headings')
+            'Market', 'Quantity', 'Amount', 'Value', 'P&L'), show='headings')
         self.tree.heading('Market', text='Market')
         self.tree.heading('Quantity', text='Quantity')
         self.tree.heading('Amount', text='Amount')
+        self.tree.heading('Value', text='Value')
+        self.tree.heading('P&L', text='P&L')
         self.tree.pack(fill='both', expand=True)
 
         self.tree.column('Market', anchor='center')
         self.tree.column('Quantity', anchor='center')
         self.tree.column('Amount', anchor='center')
+        self.tree.column('Value', anchor='center')
+        self.tree.column('P&L', anchor='center')
+
+        self.totals_label = tk.Label(self)
+        self.totals_label.pack(pady=5)
 
     def populate_investments(self):
-        conn = sqlite3.connect('users.db')
-        c = conn.cursor()
-        c.execute(
-            "SELECT market, quantity, amount FROM portfolios WHERE username=?", (self.username,))
-        investments = c.fetchall()
-        conn.close()
-
-        for market, quantity, amount in investments:
-            formatted_amount = f"${float(amount):.2f}"
+        self.requests.submit(
+            self, lambda: json.loads(self.server.request('get_valuation', self.username)),
+            on_done=self.show_investments,
+            on_error=lambda e: messagebox.showerror(
+                "Error", f"Could not load investments: {e}", parent=self))
+
+    def show_investments(self, valuation):
+        # positions at the latest prices, markets without one show N/A
+        for position in valuation['positions']:
+            if position['price'] is None:
+                value = pnl = "N/A"
+            else:
+                value = f"${position['value']:.2f}"
+                pnl = f"{position['pnl']:+.2f}"
             self.tree.insert('', 'end', values=(
-                market, quantity, formatted_amount))
+                position['market'], position['quantity'], f"${float(position['amount']):.2f}",
+                value, pnl))
+        totals = valuation['totals']
+        self.totals_label.config(
+            text=f"Paid: ${totals['cost']:.2f}   Value: ${totals['value']:.2f}   P&L: {totals['pnl']:+.2f}")
+
+
+class TransactionsWindow(tk.Toplevel, CenteredTkWindow):
+    # Class for the transaction history. Pages are asked for one at a time,
+    # the next one when the user scrolls near the end of what is loaded
+    TYPES = ('All', 'deposit', 'withdraw', 'buy', 'sell')
+
+    def __init__(self, parent, username):
+        # initialization of the class
+        super().__init__(parent)
+        self.server = parent.server
+        self.requests = parent.requests
+        self.username = username
+        self.next_cursor = None  # where the next page starts, None at the end
+        self.loading = None  # the page request in flight
+        self.title(f"{username}'s Transactions")
+        self.geometry("700x450")
+        self.create_widgets()
+        self.reload()
+        self.center_window()
+
+    def create_widgets(self):
+        """ GUI components - Button, Input Block, Labels"""
+        filter_frame = tk.Frame(self)
+        filter_frame.pack(pady=5)
+
+        tk.Label(filter_frame, text="Type:").pack(side='left')
+        self.type_var = tk.StringVar(value='All')
+        tk.OptionMenu(filter_frame, self.type_var, *self.TYPES).pack(side='left', padx=5)
+
+        tk.Label(filter_frame, text="Market:").pack(side='left')
+        self.market_entry = tk.Entry(filter_frame)
+        self.market_entry.pack(side='left', padx=5)
+
+        tk.Button(filter_frame, text="Apply", command=self.reload).pack(side='left')
+
+        tree_frame = tk.Frame(self)
+        tree_frame.pack(fill='both', expand=True)
+
+        self.tree = ttk.Treeview(tree_frame, columns=(
+            'Date', 'Type', 'Market', 'Amount'), show='headings')
+        for column in ('Date', 'Type', 'Market', 'Amount'):
+            self.tree.heading(column, text=column)
+            self.tree.column(column, anchor='center')
+
+        scrollbar = ttk.Scrollbar(tree_frame, orient='vertical', command=self.tree.yview)
+        scrollbar.pack(side='right', fill='y')
+        self.tree.configure(yscrollcommand=lambda first, last: (
+            scrollbar.set(first, last), self.on_scroll(last)))
+        self.tree.pack(fill='both', expand=True)
+
+        self.status_label = tk.Label(self)
+        self.status_label.pack(pady=5)
+
+    def reload(self):
+        # start again from the newest transaction with the current filters
+        if self.loading is not None:
+            self.loading.cancel()
+            self.loading = None
+        self.tree.delete(*self.tree.get_children())
+        self.next_cursor = None
+        self.load_page()
+
+    def load_page(self):
+        kind = self.type_var.get()
+        self.loading = self.requests.submit(
+            self, self.server.request_stream, 'get_transactions', self.username,
+            TRANSACTION_PAGE, self.next_cursor or '', '' if kind == 'All' else kind,
+            self.market_entry.get().strip(),
+            on_done=self.show_page, on_error=self.page_failed)
+        self.status_label.config(text="Loading...")
+
+    def show_page(self, parts):
+        self.loading = None
+        for part in parts:
+            for transaction in part['transactions']:
+                self.tree.insert('', 'end', values=(
+                    transaction['timestamp'], transaction['type'], transaction['market'] or '',
+                    f"${transaction['amount']:.2f}"))
+        self.next_cursor = parts[-1]['next']
+        count = len(self.tree.get_children())
+        more = " - scroll down for more" if self.next_cursor is not None else ""
+        self.status_label.config(text=f"{count} transactions{more}")
+        # a page that does not fill the window never scrolls, check once
+        # it is drawn whether the next one is needed already
+        self.after_idle(self.fill_window)
+
+    def page_failed(self, error):
+        self.loading = None
+        self.status_label.config(text=f"Could not load transactions: {error}")
+
+    def fill_window(self):
+        if self.winfo_exists():
+            self.on_scroll(self.tree.yview()[1])
+
+    def on_scroll(self, last):
+        # near the end of what is loaded: ask for the next page
+        if float(last) > 0.9 and self.next_cursor is not None and self.loading is None:
+            self.load_page()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,270 @@
+"""Pluggable HTML extraction for the scrapers
+
+Building a full BeautifulSoup tree of a quote page is most of the CPU a
+scrape costs, yet only a handful of elements are ever read from it. Each
+backend here turns a page into exactly what the scrapers need:
+
+    soup      - full BeautifulSoup tree, what the scrapers always did
+    strainer  - BeautifulSoup that only builds the elements we ask for
+    lxml      - strainer on the lxml parser (needs lxml installed)
+    fast      - a stream parser that watches for the wanted classes,
+                collects their text and stops once it has everything
+
+All of them give the same results: a class matches like BeautifulSoup's
+class_ (one of the element's classes, or the whole class attribute), and
+the text of scripts and styles is left out like .text does (lxml, being
+another parser, can still differ on broken markup). tests/test_extractors.py
+checks this on the pages in tests/fixtures. To check other saved pages run
+
+    python extractors.py stock page.html ...
+    python extractors.py crypto page.html ...
+"""
+import logging
+import re
+import sys
+from html.parser import HTMLParser
+
+from bs4 import BeautifulSoup, SoupStrainer
+
+DEFAULT_BACKEND = 'fast'
+
+STOCK_NAME = 'QuoteStrip-name'
+STOCK_TRADE_TIME = 'QuoteStrip-extendedLastTradeTime'
+STOCK_PRICE = 'QuoteStrip-lastPriceStripContainer'
+CRYPTO_NAME = 'profile__name'
+CRYPTO_VALUTA = 'valuta valuta--light'
+CRYPTO_COINS = 10  # coins on the crypto page we keep
+
+PRICE_PATTERN = re.compile(r'[\d,]+\.\d+')
+
+# tags that never have an end tag
+VOID_TAGS = frozenset(['area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input',
+                       'link', 'meta', 'param', 'source', 'track', 'wbr'])
+# tags whose text BeautifulSoup's .text leaves out
+HIDDEN_TEXT_TAGS = frozenset(['script', 'style'])
+
+
+def stock_fields(name, last_trade_time, last_price_full):
+    # turn the raw texts of a quote page into (name, last trade time, price)
+    last_trade_time = last_trade_time.replace(
+        "After Hours: Last | ", "") if last_trade_time is not None else "N/A"
+    last_price = PRICE_PATTERN.search(
+        last_price_full).group(0) if last_price_full else "N/A"
+    return name, last_trade_time, last_price
+
+
+def clean_valuta(text):
+    return text.replace("\n", "").replace("        ", "")  # formation
+
+
+# BeautifulSoup based backends
+
+def _class_matcher(classes):
+    # While parsing, a strainer sees the raw class attribute, so
+    # class_=[...] would miss an element with one more class than asked
+    # for. Match on each class or the whole attribute like find(class_=)
+    wanted = frozenset(classes)
+
+    def matches(value):
+        return value is not None and (value in wanted or not wanted.isdisjoint(value.split()))
+    return matches
+
+
+def _soup(html, backend, classes):
+    if backend == 'soup':
+        return BeautifulSoup(html, 'html.parser')
+    parser = 'lxml' if backend == 'lxml' else 'html.parser'
+    return BeautifulSoup(html, parser, parse_only=SoupStrainer(class_=_class_matcher(classes)))
+
+
+def _soup_stock(html, backend):
+    soup = _soup(html, backend, [STOCK_NAME, STOCK_TRADE_TIME, STOCK_PRICE])
+    name = soup.find(class_=STOCK_NAME).text
+    trade_time = soup.find(class_=STOCK_TRADE_TIME)
+    return stock_fields(name, trade_time.text if trade_time else None,
+                        soup.find(class_=STOCK_PRICE).text)
+
+
+def _soup_crypto(html, backend):
+    soup = _soup(html, backend, [CRYPTO_NAME, CRYPTO_VALUTA])
+    names = soup.find_all(class_=CRYPTO_NAME)[:CRYPTO_COINS]
+    all_valuta = soup.find_all(class_=CRYPTO_VALUTA)[:CRYPTO_COINS * 2]
+    return [[name.get_text(strip=True),
+             clean_valuta(price.get_text(strip=True)),
+             clean_valuta(market_cap.get_text(strip=True))]
+            for name, price, market_cap in zip(names, all_valuta[::2], all_valuta[1::2])]
+
+
+# stream backend
+
+class _StopParsing(Exception):
+    pass
+
+
+class ClassExtractor(HTMLParser):
+    # Collects the text of elements by class without building a tree.
+    # wanted maps a class selector to how many matches to keep; a selector
+    # matches like BeautifulSoup's class_: one of the element's classes or
+    # the whole class attribute. Parsing stops once every selector is full
+    def __init__(self, wanted):
+        # initialization of the class
+        super().__init__(convert_charrefs=True)
+        self.wanted = dict(wanted)
+        self.found = {selector: [] for selector in wanted}
+        self.open = []  # [strings, stack of open tags] of elements being read
+        self.hidden = 0  # script or style elements we are inside
+
+    def extract(self, html):
+        try:
+            self.feed(html)
+            self.close()
+        except _StopParsing:
+            pass
+        return self.found
+
+    def handle_starttag(self, tag, attrs):
+        if tag in HIDDEN_TEXT_TAGS:
+            self.hidden += 1
+        for strings, stack in self.open:
+            if tag not in VOID_TAGS:
+                stack.append(tag)
+        classes = None
+        for key, value in attrs:
+            if key == 'class' and value is not None:
+                classes = value
+        if classes is None:
+            return
+        class_list = classes.split()
+        for selector, limit in self.wanted.items():
+            found = self.found[selector]
+            if len(found) < limit and (selector in class_list or selector == classes):
+                strings = []
+                found.append(strings)
+                if tag in VOID_TAGS:
+                    self._check_done()
+                else:
+                    self.open.append([strings, [tag]])
+
+    def handle_startendtag(self, tag, attrs):
+        self.handle_starttag(tag, attrs)
+        if tag not in VOID_TAGS:
+            self.handle_endtag(tag)
+
+    def handle_endtag(self, tag):
+        if tag in HIDDEN_TEXT_TAGS and self.hidden:
+            self.hidden -= 1
+        still_open = []
+        for strings, stack in self.open:
+            if tag in stack:
+                # like the html.parser tree builder, an end tag closes
+                # everything opened after its start tag
+                del stack[len(stack) - 1 - stack[::-1].index(tag):]
+            if stack:
+                still_open.append([strings, stack])
+        if len(still_open) != len(self.open):
+            self.open = still_open
+            self._check_done()
+
+    def handle_data(self, data):
+        if self.hidden:
+            return
+        for strings, stack in self.open:
+            strings.append(data)
+
+    def unknown_decl(self, data):
+        # <![CDATA[...]]> is text to BeautifulSoup
+        if data.startswith('CDATA['):
+            self.handle_data(data[len('CDATA['):])
+
+    def _check_done(self):
+        if not self.open and all(len(self.found[selector]) >= limit
+                                 for selector, limit in self.wanted.items()):
+            raise _StopParsing()
+
+
+def _text(strings, strip=False):
+    # the .text / .get_text(strip=True) of an element read by ClassExtractor
+    if strip:
+        return ''.join(s.strip() for s in strings if s.strip())
+    return ''.join(strings)
+
+
+def _fast_stock(html):
+    found = ClassExtractor({STOCK_NAME: 1, STOCK_TRADE_TIME: 1,
+                            STOCK_PRICE: 1}).extract(html)
+    if not found[STOCK_NAME] or not found[STOCK_PRICE]:
+        raise AttributeError('quote strip not found')
+    trade_time = found[STOCK_TRADE_TIME]
+    return stock_fields(_text(found[STOCK_NAME][0]),
+                        _text(trade_time[0]) if trade_time else None,
+                        _text(found[STOCK_PRICE][0]))
+
+
+def _fast_crypto(html):
+    found = ClassExtractor({CRYPTO_NAME: CRYPTO_COINS,
+                            CRYPTO_VALUTA: CRYPTO_COINS * 2}).extract(html)
+    names = found[CRYPTO_NAME]
+    all_valuta = found[CRYPTO_VALUTA]
+    return [[_text(name, strip=True),
+             clean_valuta(_text(price, strip=True)),
+             clean_valuta(_text(market_cap, strip=True))]
+            for name, price, market_cap in zip(names, all_valuta[::2], all_valuta[1::2])]
+
+
+BACKENDS = ('soup', 'strainer', 'lxml', 'fast')
+
+
+def _check_backend(backend):
+    if backend not in BACKENDS:
+        raise ValueError(f'Unknown extraction backend: {backend}')
+    if backend == 'lxml':
+        try:
+            import lxml  # noqa: F401
+        except ImportError:
+            logging.warning('lxml is not installed, using html.parser')
+            return 'strainer'
+    return backend
+
+
+def extract_stock(html, backend=DEFAULT_BACKEND):
+    # (name, last trade time, last price) of a quote page,
+    # raises AttributeError when the page has no quote
+    backend = _check_backend(backend)
+    if backend == 'fast':
+        return _fast_stock(html)
+    return _soup_stock(html, backend)
+
+
+def extract_crypto(html, backend=DEFAULT_BACKEND):
+    # [name, price, market cap] of the top coins on the crypto page
+    backend = _check_backend(backend)
+    if backend == 'fast':
+        return _fast_crypto(html)
+    return _soup_crypto(html, backend)
+
+
+def compare_backends(kind, html):
+    # {backend: result} for one page, errors are reported as their type
+    extract = extract_stock if kind == 'stock' else extract_crypto
+    results = {}
+    for backend in BACKENDS:
+        try:
+            results[backend] = extract(html, backend)
+        except AttributeError as e:
+            results[backend] = type(e).__name__
+    return results
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 3 or sys.argv[1] not in ('stock', 'crypto'):
+        sys.exit('usage: python extractors.py stock|crypto page.html ...')
+    failed = False
+    for path in sys.argv[2:]:
+        with open(path, encoding='utf-8') as f:
+            results = compare_backends(sys.argv[1], f.read())
+        expected = results['soup']
+        different = [backend for backend, result in results.items()
+                     if result != expected]
+        failed = failed or bool(different)
+        print(f"{path}: {'differs in ' + ', '.join(different) if different else 'ok'}")
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,112 @@
+"""HTTP cache for the scrapers
+
+HTTPCache remembers, per URL, the ETag and Last-Modified headers of the
+last download and what the scraper parsed out of it (store_parsed), in a
+small sqlite file so it survives restarts. fetch makes a conditional
+request, and a 304 answer reuses the parsed result without parsing
+anything. Within a URL's TTL there is no request at all.
+
+Page bodies are not kept, only the parsed result, so the file stays small
+even for thousands of quote pages.
+"""
+import json
+import threading
+import time
+from collections import namedtuple
+
+from db_pool import ConnectionPool
+
+DEFAULT_TTL = 0  # seconds a page is trusted without asking the server again
+
+# the cache can be rebuilt from the web, so it does not need fsync per write
+PRAGMAS = (
+    ('journal_mode', 'WAL'),
+    ('synchronous', 'NORMAL'),
+    ('busy_timeout', 5000),
+)
+
+# text is None when the page did not change, parsed is what the scraper
+# stored for it last time
+CachedPage = namedtuple('CachedPage', ['url', 'text', 'changed', 'parsed'])
+
+
+class HTTPCache:
+    # Conditional, TTL aware GETs backed by a sqlite file
+    def __init__(self, path, ttl=DEFAULT_TTL, ttls=None):
+        # initialization of the class
+        self.pool = ConnectionPool(path, pragmas=PRAGMAS)
+        self.ttl = ttl
+        self.ttls = dict(ttls or {})  # url prefix -> ttl in seconds
+        self.lock = threading.Lock()
+        self.created = False
+        self.fresh = 0  # answered inside the TTL, no request
+        self.not_modified = 0  # 304, nothing downloaded or parsed
+        self.downloaded = 0  # full 200 answers
+
+    def connection(self):
+        conn = self.pool.get()
+        if not self.created:
+            conn.execute('''CREATE TABLE IF NOT EXISTS pages
+                            (url TEXT PRIMARY KEY,
+                             etag TEXT,
+                             last_modified TEXT,
+                             fetched_at REAL NOT NULL,
+                             parsed TEXT)''')
+            conn.commit()
+            self.created = True
+        return conn
+
+    def ttl_for(self, url):
+        # the longest matching prefix wins
+        matches = [prefix for prefix in self.ttls if url.startswith(prefix)]
+        return self.ttls[max(matches, key=len)] if matches else self.ttl
+
+    def _count(self, counter):
+        with self.lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def fetch(self, session, url, timeout=None):
+        # GET url through the cache, raises like raise_for_status on errors
+        conn = self.connection()
+        row = conn.execute('SELECT etag, last_modified, fetched_at, parsed FROM pages WHERE url = ?',
+                           (url,)).fetchone()
+        now = time.time()
+        headers = {}
+        if row is not None and row[3] is not None:
+            etag, last_modified, fetched_at, parsed = row
+            if now - fetched_at < self.ttl_for(url):
+                self._count('fresh')
+                return CachedPage(url, None, False, json.loads(parsed))
+            # without a parsed result there is nothing to reuse on a 304
+            if etag:
+                headers['If-None-Match'] = etag
+            if last_modified:
+                headers['If-Modified-Since'] = last_modified
+
+        response = session.get(url, headers=headers, timeout=timeout)
+        if response.status_code == 304 and headers:
+            conn.execute('UPDATE pages SET fetched_at = ? WHERE url = ?', (now, url))
+            conn.commit()
+            self._count('not_modified')
+            return CachedPage(url, None, False, json.loads(row[3]))
+
+        response.raise_for_status()
+        conn.execute('''INSERT OR REPLACE INTO pages (url, etag, last_modified, fetched_at, parsed)
+                        VALUES (?, ?, ?, ?, NULL)''',
+                     (url, response.headers.get('ETag'),
+                      response.headers.get('Last-Modified'), now))
+        conn.commit()
+        self._count('downloaded')
+        return CachedPage(url, response.text, True, None)
+
+    def store_parsed(self, url, parsed):
+        # remember what was parsed out of the page fetch just returned
+        conn = self.connection()
+        conn.execute('UPDATE pages SET parsed = ? WHERE url = ?',
+                     (json.dumps(parsed), url))
+        conn.commit()
+
+    def stats(self):
+        with self.lock:
+            return {'fresh': self.fresh, 'not_modified': self.not_modified,
+                    'downloaded': self.downloaded}
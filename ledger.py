@@ -0,0 +1,161 @@
+"""Single writer for every balance change
+
+Deposits, withdrawals, investments and sales are queued here and applied
+in order by one writer thread on its own connection. Whatever is queued
+when the writer is free goes into the same transaction (group commit),
+and a command is only answered once the commit holding it is on disk.
+
+    writer = get_writer('users.db')
+    result = writer.execute(func, *args)  # func(cursor, *args)
+"""
+import queue
+import threading
+import time
+from concurrent.futures import Future, InvalidStateError
+
+from db_pool import get_pool
+
+MAX_GROUP = 256  # most commands committed together
+GROUP_WAIT = 0.0  # seconds to wait for more commands before committing
+
+_STOP = object()
+
+
+def _resolve(future, result=None, error=None):
+    # answer a future that may have been cancelled or answered already;
+    # the writer thread must never die of it
+    try:
+        if error is None:
+            future.set_result(result)
+        else:
+            future.set_exception(error)
+    except InvalidStateError:
+        pass
+
+
+class LedgerWriter:
+    # Applies ledger commands one after another on its own connection
+    def __init__(self, database, max_group=MAX_GROUP, group_wait=GROUP_WAIT):
+        # initialization of the class
+        self.database = database
+        self.max_group = max_group
+        # 0 commits whatever is already queued, more waits to build bigger groups
+        self.group_wait = group_wait
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(
+            target=self.run, name='ledger-writer', daemon=True)
+        self.commit_hooks = []
+        self.groups = 0
+        self.commands = 0
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        # finish what is queued, then stop the writer thread
+        self.queue.put(_STOP)
+        self.thread.join()
+
+    def add_commit_hook(self, hook):
+        # hook(conn, committed) runs on the writer thread after each commit and
+        # before anyone is answered; committed is the (func, args) of every
+        # command that made it into the commit
+        self.commit_hooks.append(hook)
+
+    def submit(self, func, *args):
+        # queue func(cursor, *args), the future holds its result or error
+        future = Future()
+        self.queue.put((func, args, future))
+        return future
+
+    def execute(self, func, *args):
+        # queue a command and wait until it is committed
+        return self.submit(func, *args).result()
+
+    def run(self):
+        conn = get_pool(self.database).get()
+        stopping = False
+        while not stopping:
+            item = self.queue.get()
+            if item is _STOP:
+                break
+            group = [item]
+            deadline = time.monotonic() + self.group_wait
+            while len(group) < self.max_group:
+                try:
+                    item = self.queue.get(
+                        timeout=max(0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if item is _STOP:
+                    stopping = True
+                    break
+                group.append(item)
+            try:
+                self.apply(conn, group)
+            except Exception as e:
+                print(f'Ledger writer failed: {e}')
+                for _, _, future in group:
+                    _resolve(future, error=e)
+
+    def apply(self, conn, group):
+        # one transaction for the whole group, a savepoint per command so
+        # a refused command does not undo the others. Commands whose
+        # future was cancelled while queued are dropped, not applied
+        group = [item for item in group if item[2].set_running_or_notify_cancel()]
+        if not group:
+            return
+        cursor = conn.cursor()
+        outcomes = []
+        try:
+            cursor.execute('BEGIN IMMEDIATE')
+            for func, args, future in group:
+                cursor.execute('SAVEPOINT ledger_command')
+                try:
+                    result = func(cursor, *args)
+                except Exception as e:
+                    cursor.execute('ROLLBACK TO SAVEPOINT ledger_command')
+                    cursor.execute('RELEASE SAVEPOINT ledger_command')
+                    outcomes.append((future, None, e))
+                else:
+                    cursor.execute('RELEASE SAVEPOINT ledger_command')
+                    outcomes.append((future, result, None))
+            conn.commit()
+        except Exception as e:
+            # the group could not be committed, so none of it was saved
+            if conn.in_transaction:
+                conn.rollback()
+            for _, _, future in group:
+                _resolve(future, error=e)
+            return
+        finally:
+            cursor.close()
+
+        self.groups += 1
+        self.commands += len(group)
+        committed = [(func, args) for (func, args, _), (_, _, error)
+                     in zip(group, outcomes) if error is None]
+        for hook in self.commit_hooks:
+            try:
+                hook(conn, committed)
+            except Exception as e:
+                print(f'Ledger commit hook failed: {e}')
+        for future, result, error in outcomes:
+            _resolve(future, result, error)
+
+
+_writers = {}
+_writers_lock = threading.Lock()
+
+
+def get_writer(database, commit_hooks=()):
+    # the one writer for a database file, started on first use.
+    # commit_hooks are only added when the writer is created
+    with _writers_lock:
+        writer = _writers.get(database)
+        if writer is None:
+            writer = _writers[database] = LedgerWriter(database)
+            for hook in commit_hooks:
+                writer.add_commit_hook(hook)
+            writer.start()
+        return writer
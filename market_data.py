@@ -0,0 +1,68 @@
+"""Cached market CSV files
+
+market_data.load(path, market) reads a market file once per process and
+keeps the cleaned frame: prices are floats, every other column is text.
+A file is only read again when its modification time or size changes,
+so a new scrape is picked up on the next load.
+
+The frames are shared by every caller, do not modify them.
+"""
+import os
+import threading
+
+import pandas as pd
+
+from quotes import STOCKS, CRYPTO
+
+# price column of each market's file, the same names the client uses
+PRICE_COLUMNS = {
+    STOCKS: 'Last Price',
+    CRYPTO: 'Price',
+}
+
+
+def read_market_csv(path, market):
+    # a market file as a DataFrame with the price column as floats
+    frame = pd.read_csv(path, dtype=str, keep_default_na=False)
+    price_column = PRICE_COLUMNS[market]
+    frame[price_column] = pd.to_numeric(
+        frame[price_column].str.replace(r'[$,]', '', regex=True), errors='coerce')
+    return frame
+
+
+class MarketDataCache:
+    # Cleaned DataFrames of market files, keyed by path, mtime and size
+    def __init__(self):
+        # initialization of the class
+        self.lock = threading.Lock()
+        self.frames = {}  # path -> ((mtime_ns, size), frame)
+        self.hits = 0
+        self.loads = 0
+
+    def load(self, path, market):
+        # the file's frame, read again only when the file has changed.
+        # Raises OSError like open() when the file is missing
+        stat = os.stat(path)
+        key = (stat.st_mtime_ns, stat.st_size)
+        with self.lock:
+            cached = self.frames.get(path)
+            if cached is not None and cached[0] == key:
+                self.hits += 1
+                return cached[1]
+        frame = read_market_csv(path, market)
+        with self.lock:
+            self.frames[path] = (key, frame)
+            self.loads += 1
+        return frame
+
+    def clear(self):
+        with self.lock:
+            self.frames.clear()
+
+    def stats(self):
+        with self.lock:
+            return {'files': len(self.frames), 'hits': self.hits, 'loads': self.loads}
+
+
+# shared by every window of the process
+market_data = MarketDataCache()
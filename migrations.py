@@ -0,0 +1,89 @@
+"""Versioned schema migrations for users.db
+
+create_database_and_tables only creates missing tables, it never changes
+one that already exists. Everything after that goes here: each migration
+has a version number and a list of statements, runs once and in order
+inside its own transaction, and the version reached is stored in the
+database header (PRAGMA user_version). Existing users.db files are
+upgraded in place the next time the server starts, or by running
+
+    python migrations.py users.db
+"""
+import sqlite3
+import sys
+
+MIGRATIONS = [
+    (1, 'index portfolios by user and market', [
+        # covers the position lookups in invest and sell_stock, so they
+        # are answered from the index without touching the table
+        '''CREATE INDEX IF NOT EXISTS idx_portfolios_user_market
+           ON portfolios (username, market, quantity, amount)''',
+    ]),
+    (2, 'index transactions by user and time', [
+        '''CREATE INDEX IF NOT EXISTS idx_transactions_user_time
+           ON transactions (username, timestamp)''',
+    ]),
+    (3, 'one position per user and market', [
+        # invest used to add a new row per purchase, fold those into one
+        '''CREATE TEMP TABLE merged_positions AS
+           SELECT MIN(id) AS id, SUM(quantity) AS quantity, SUM(amount) AS amount
+           FROM portfolios GROUP BY username, market HAVING COUNT(*) > 1''',
+        '''UPDATE portfolios
+           SET quantity = (SELECT quantity FROM merged_positions m WHERE m.id = portfolios.id),
+               amount = (SELECT amount FROM merged_positions m WHERE m.id = portfolios.id)
+           WHERE id IN (SELECT id FROM merged_positions)''',
+        '''DELETE FROM portfolios WHERE id NOT IN
+           (SELECT MIN(id) FROM portfolios GROUP BY username, market)''',
+        'DROP TABLE merged_positions',
+        '''CREATE UNIQUE INDEX IF NOT EXISTS ux_portfolios_position
+           ON portfolios (username, market)''',
+    ]),
+    (4, 'index transactions by user, type or market, and time', [
+        # get_transactions pages through these newest first; an index
+        # entry ends with the row id, so (timestamp, id) is in index order
+        '''CREATE INDEX IF NOT EXISTS idx_transactions_user_type_time
+           ON transactions (username, transaction_type, timestamp)''',
+        '''CREATE INDEX IF NOT EXISTS idx_transactions_user_market_time
+           ON transactions (username, market, timestamp)''',
+    ]),
+    (5, 'remember how far bulk imports got', [
+        # see bulk_io.py, updated in the same transaction as the rows
+        '''CREATE TABLE IF NOT EXISTS import_checkpoints
+           (source TEXT PRIMARY KEY,
+            offset INTEGER NOT NULL,
+            rows INTEGER NOT NULL)''',
+    ]),
+]
+
+
+def schema_version(conn):
+    return conn.execute('PRAGMA user_version').fetchone()[0]
+
+
+def migrate(conn, migrations=MIGRATIONS):
+    # bring the database up to the newest version, returns that version
+    version = schema_version(conn)
+    for target, description, statements in migrations:
+        if target <= version:
+            continue
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            for statement in statements:
+                conn.execute(statement)
+            conn.execute(f'PRAGMA user_version = {target}')
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        print(f'Migrated database to version {target}: {description}')
+        version = target
+    return version
+
+
+if __name__ == '__main__':
+    database = sys.argv[1] if len(sys.argv) > 1 else 'users.db'
+    conn = sqlite3.connect(database)
+    try:
+        print(f'{database} is at version {migrate(conn)}')
+    finally:
+        conn.close()
@@ -0,0 +1,165 @@
+"""Append-only price history
+
+Every scrape overwrites stocks.csv and cryptocurrencies.csv, so old prices
+were lost. The history keeps every scraped price as a row of
+(symbol id, time, price), one fixed-width binary file per column:
+
+    symbol.bin  uint32   id of the symbol, its line in symbols.txt
+    time.bin    float64  seconds since the epoch
+    price.bin   float64
+
+Rows are only ever appended, in time order. For each symbol,
+index/<id>.bin lists its row numbers (int64), so one symbol's rows are
+found without reading anyone else's. A range query memory-maps the files,
+binary searches the symbol's rows by time, and only reads the pages of
+the rows it returns. A multi-year chart therefore never loads whole files
+into memory.
+
+A crash in the middle of an append can leave the column files with
+different lengths. They are cut back to the shortest when the history is
+opened, and index entries past the last row are ignored.
+"""
+import bisect
+import os
+import threading
+import time
+
+import numpy as np
+
+COLUMNS = (
+    ('symbol', np.uint32),
+    ('time', np.float64),
+    ('price', np.float64),
+)
+INDEX_DTYPE = np.int64
+
+
+class PriceHistory:
+    # Price rows of every symbol in memory-mapped column files
+    def __init__(self, directory):
+        # initialization of the class
+        self.directory = directory
+        os.makedirs(os.path.join(directory, 'index'), exist_ok=True)
+        self.lock = threading.Lock()  # one append at a time
+        self.ids = {}  # symbol -> id
+        self.names = []  # id -> symbol
+        symbols_path = os.path.join(directory, 'symbols.txt')
+        if os.path.exists(symbols_path):
+            with open(symbols_path, encoding='utf-8') as f:
+                self.names = f.read().splitlines()
+            self.ids = {name: symbol_id for symbol_id, name in enumerate(self.names)}
+        self.rows = self._repair()
+        times = self._column('time', self.rows)
+        self.last_time = float(times[-1]) if self.rows else 0.0
+
+    def _path(self, column):
+        return os.path.join(self.directory, f'{column}.bin')
+
+    def _index_path(self, symbol_id):
+        return os.path.join(self.directory, 'index', f'{symbol_id}.bin')
+
+    def _repair(self):
+        # rows every column file has, longer files are cut back to it
+        sizes = {column: os.path.getsize(self._path(column)) // np.dtype(dtype).itemsize
+                 if os.path.exists(self._path(column)) else 0
+                 for column, dtype in COLUMNS}
+        rows = min(sizes.values())
+        for column, dtype in COLUMNS:
+            if os.path.exists(self._path(column)) and \
+                    os.path.getsize(self._path(column)) != rows * np.dtype(dtype).itemsize:
+                with open(self._path(column), 'r+b') as f:
+                    f.truncate(rows * np.dtype(dtype).itemsize)
+        return rows
+
+    def _column(self, column, rows):
+        # the first rows values of a column, mapped rather than read
+        dtype = dict(COLUMNS)[column]
+        if rows == 0:
+            return np.empty(0, dtype=dtype)
+        return np.memmap(self._path(column), dtype=dtype, mode='r', shape=(rows,))
+
+    def _index(self, symbol_id, rows):
+        # row numbers of a symbol that are below rows
+        path = self._index_path(symbol_id)
+        count = os.path.getsize(path) // np.dtype(INDEX_DTYPE).itemsize \
+            if os.path.exists(path) else 0
+        if count == 0:
+            return np.empty(0, dtype=INDEX_DTYPE)
+        index = np.memmap(path, dtype=INDEX_DTYPE, mode='r', shape=(count,))
+        return index[:np.searchsorted(index, rows)]
+
+    @staticmethod
+    def _symbol_name(symbol):
+        # symbols.txt has one symbol per line, so a symbol never has a line
+        # break; used for every lookup, so a reload finds the same name
+        return ' '.join(str(symbol).splitlines())
+
+    def _symbol_id(self, symbol):
+        # id of a symbol, new symbols are added to symbols.txt
+        symbol = self._symbol_name(symbol)
+        symbol_id = self.ids.get(symbol)
+        if symbol_id is None:
+            symbol_id = len(self.names)
+            with open(os.path.join(self.directory, 'symbols.txt'), 'a', encoding='utf-8') as f:
+                f.write(symbol + '\n')
+            self.names.append(symbol)
+            self.ids[symbol] = symbol_id
+        return symbol_id
+
+    def append(self, prices, timestamp=None):
+        # add one scrape, prices is (symbol, price) pairs. Prices that are
+        # None are skipped. Returns how many rows were added
+        with self.lock:
+            # never go back in time, range queries rely on the order
+            timestamp = max(time.time() if timestamp is None else timestamp, self.last_time)
+            pairs = [(self._symbol_id(symbol), price) for symbol, price in prices
+                     if price is not None]
+            if not pairs:
+                return 0
+            ids = np.array([symbol_id for symbol_id, price in pairs], dtype=np.uint32)
+            data = {
+                'symbol': ids,
+                'time': np.full(len(pairs), timestamp, dtype=np.float64),
+                'price': np.array([price for symbol_id, price in pairs], dtype=np.float64),
+            }
+            for column, dtype in COLUMNS:
+                with open(self._path(column), 'ab') as f:
+                    f.write(data[column].astype(dtype).tobytes())
+            # each symbol's new row numbers, one write per index file
+            rows = np.arange(self.rows, self.rows + len(pairs), dtype=INDEX_DTYPE)
+            order = np.argsort(ids, kind='stable')
+            symbol_ids, starts = np.unique(ids[order], return_index=True)
+            for symbol_id, symbol_rows in zip(symbol_ids.tolist(), np.split(rows[order], starts[1:])):
+                with open(self._index_path(symbol_id), 'ab') as f:
+                    f.write(symbol_rows.tobytes())
+            self.rows += len(pairs)
+            self.last_time = timestamp
+            return len(pairs)
+
+    def range(self, symbol, start=None, end=None):
+        # (times, prices) of a symbol from start to end (seconds, both
+        # included, None for no limit), oldest first
+        with self.lock:
+            rows = self.rows
+            symbol_id = self.ids.get(self._symbol_name(symbol))
+        if symbol_id is None:
+            return np.empty(0), np.empty(0)
+        index = self._index(symbol_id, rows)
+        times = self._column('time', rows)
+
+        def time_of(i):
+            return times[index[i]]
+
+        low = 0 if start is None else bisect.bisect_left(
+            range(len(index)), start, key=time_of)
+        high = len(index) if end is None else bisect.bisect_right(
+            range(len(index)), end, key=time_of)
+        selected = np.asarray(index[low:high])
+        return np.asarray(times[selected]), np.asarray(self._column('price', rows)[selected])
+
+    def symbols(self):
+        with self.lock:
+            return list(self.names)
+
+    def __len__(self):
+        return self.rows
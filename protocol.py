@@ -0,0 +1,131 @@
+"""Message framing shared by the server and the client
+
+Every message on the socket is a 4 byte big-endian length followed by that
+many bytes of UTF-8 text, so a message is never truncated or merged with
+the next one no matter how the bytes arrive.
+
+Requests look like 'request_id|action|arg|arg...' and responses look like
+'request_id|response'. A '|' or backslash inside an argument (a password,
+a market name) is sent with a backslash in front, so it never splits the
+argument in two. The request id lets a client send many commands without
+waiting and match each answer when it comes back, even out of order.
+Commands pipelined on one connection may run at the same time, so wait for
+the answer before sending a command that depends on it.
+"""
+import struct
+import asyncio
+
+HEADER = struct.Struct('!I')  # 4 byte unsigned length, network byte order
+MAX_FRAME = 16 * 1024 * 1024  # refuse anything bigger than 16 MB
+
+
+class ProtocolError(Exception):
+    # raised when the other side sends something that is not a valid frame
+    pass
+
+
+def encode_frame(text):
+    # turn a message into length + payload bytes
+    payload = text.encode()
+    if len(payload) > MAX_FRAME:
+        raise ProtocolError(f'Frame too large: {len(payload)} bytes')
+    return HEADER.pack(len(payload)) + payload
+
+
+def _check_length(length):
+    if length > MAX_FRAME:
+        raise ProtocolError(f'Frame too large: {length} bytes')
+    return length
+
+
+def recv_exact(sock, size):
+    # keep reading until we have exactly size bytes, None if the peer closed
+    chunks = []
+    while size:
+        chunk = sock.recv(min(size, 65536))
+        if not chunk:
+            if chunks:
+                raise ProtocolError('Connection closed in the middle of a frame')
+            return None
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b''.join(chunks)
+
+
+def send_frame(sock, text):
+    sock.sendall(encode_frame(text))
+
+
+def recv_frame(sock):
+    # read one whole message from a blocking socket, None when closed
+    header = recv_exact(sock, HEADER.size)
+    if header is None:
+        return None
+    length = _check_length(HEADER.unpack(header)[0])
+    payload = recv_exact(sock, length) if length else b''
+    if payload is None:
+        raise ProtocolError('Connection closed in the middle of a frame')
+    return payload.decode()
+
+
+async def read_frame(reader):
+    # asyncio version of recv_frame
+    try:
+        header = await reader.readexactly(HEADER.size)
+    except asyncio.IncompleteReadError as e:
+        if e.partial:
+            raise ProtocolError('Connection closed in the middle of a frame')
+        return None
+    length = _check_length(HEADER.unpack(header)[0])
+    try:
+        payload = await reader.readexactly(length)
+    except asyncio.IncompleteReadError:
+        raise ProtocolError('Connection closed in the middle of a frame')
+    return payload.decode()
+
+
+def escape_field(field):
+    return str(field).replace('\\', '\\\\').replace('|', '\\|')
+
+
+def make_command(action, *args):
+    # 'action|arg|...' with every field escaped, also used for batch commands
+    return '|'.join(escape_field(field) for field in (action,) + args)
+
+
+def split_command(text):
+    # 'action|arg|...' -> ['action', 'arg', ...], undoing make_command
+    if '\\' not in text:
+        return text.split('|')
+    fields, field = [], []
+    chars = iter(text)
+    for char in chars:
+        if char == '\\':
+            field.append(next(chars, ''))
+        elif char == '|':
+            fields.append(''.join(field))
+            field = []
+        else:
+            field.append(char)
+    fields.append(''.join(field))
+    return fields
+
+
+def make_request(request_id, action, *args):
+    return f'{request_id}|{make_command(action, *args)}'
+
+
+def split_request(text):
+    # 'id|action|args' -> ('id', ['action', 'args', ...])
+    request_id, _, command = text.partition('|')
+    return request_id, split_command(command)
+
+
+def make_response(request_id, response):
+    return f'{request_id}|{response}'
+
+
+def split_response(text):
+    # 'id|response' -> ('id', 'response')
+    request_id, _, response = text.partition('|')
+    return request_id, response
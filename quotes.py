@@ -0,0 +1,111 @@
+"""In-memory quote store
+
+The scrapers write their results into the store and everything else prices
+from it: the get_quotes action, sell_stock and invest. Every quote carries
+the store version it last changed in, so a client that remembers the
+version it has seen only asks for what changed since.
+
+A quote is a dict: symbol, market, price (a float) and whatever extra
+fields the market has (last_trade_time and ticker for stocks, market_cap
+for coins). A quote that a scrape could not refresh but that is still
+listed keeps its price with stale set to True; updated stays the time it
+was last scraped.
+"""
+import threading
+import time
+
+STOCKS = 'Stocks'
+CRYPTO = 'Cryptocurrency'
+
+
+def parse_price(text):
+    # '$1,234.50' -> 1234.5, None if there is no number in it
+    try:
+        return float(str(text).replace('$', '').replace(',', '').strip())
+    except ValueError:
+        return None
+
+
+class QuoteStore:
+    # Latest quote per symbol, versioned so changes can be sent as deltas
+    def __init__(self):
+        # initialization of the class
+        self.lock = threading.Lock()
+        self.quotes = {}  # symbol -> quote
+        self.removed = {}  # symbol -> version it disappeared in
+        self.version = 0
+        self.listeners = []
+
+    def add_listener(self, listener):
+        # listener(version, changed, removed) runs after every update that
+        # changed something, on the updating thread, so it must not block
+        self.listeners.append(listener)
+
+    def update(self, market, quotes, keep=None):
+        # replace every quote of a market with a fresh scrape, returns the
+        # new version. Quotes whose price and fields did not change keep
+        # their old version. A quote missing from the scrape is removed,
+        # unless keep(quote) is true: then it is kept and marked stale
+        now = time.time()
+        with self.lock:
+            version = self.version + 1
+            changed = {}
+            seen = set()
+            for quote in quotes:
+                symbol = quote['symbol']
+                seen.add(symbol)
+                old = self.quotes.get(symbol)
+                new = dict(quote, market=market)
+                if old is not None and {k: v for k, v in old.items()
+                                        if k not in ('version', 'updated')} == new:
+                    continue
+                new['version'] = version
+                new['updated'] = now
+                self.quotes[symbol] = new
+                self.removed.pop(symbol, None)
+                changed[symbol] = new
+            missing = [symbol for symbol, quote in self.quotes.items()
+                       if quote['market'] == market and symbol not in seen]
+            removed = []
+            for symbol in missing:
+                quote = self.quotes[symbol]
+                if keep is None or not keep(quote):
+                    removed.append(symbol)
+                elif not quote.get('stale'):
+                    changed[symbol] = self.quotes[symbol] = dict(quote, stale=True, version=version)
+            for symbol in removed:
+                del self.quotes[symbol]
+                self.removed[symbol] = version
+            if not changed and not removed:
+                return self.version
+            self.version = version
+        for listener in self.listeners:
+            try:
+                listener(version, changed, removed)
+            except Exception as e:
+                print(f'Quote listener failed: {e}')
+        return version
+
+    def snapshot(self, symbols=None, since=0):
+        # {'version', 'quotes', 'removed'}: quotes changed after version
+        # since (all of them for 0), optionally only for some symbols
+        with self.lock:
+            wanted = self.quotes.keys() if symbols is None else [
+                symbol for symbol in symbols if symbol in self.quotes]
+            quotes = {symbol: self.quotes[symbol] for symbol in wanted
+                      if self.quotes[symbol]['version'] > since}
+            removed = [symbol for symbol, version in self.removed.items()
+                       if since and version > since
+                       and (symbols is None or symbol in symbols)]
+            return {'version': self.version, 'quotes': quotes, 'removed': removed}
+
+    def prices(self):
+        # {symbol: price} of every quote, for pricing many positions at once
+        with self.lock:
+            return {symbol: quote['price'] for symbol, quote in self.quotes.items()}
+
+    def price(self, symbol):
+        # latest price of a symbol, None if the store does not know it
+        with self.lock:
+            quote = self.quotes.get(symbol)
+            return quote['price'] if quote is not None else None
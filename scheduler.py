@@ -0,0 +1,102 @@
+"""Background refresh of the scraped market data
+
+RefreshScheduler runs each job added with add() on its own background
+thread: once right away, then again every interval seconds, plus or minus
+some jitter so jobs do not all hit the web at the same moment. A job
+never overlaps with itself, run_now() runs one out of turn, and status()
+reports the time of each job's last successful run.
+"""
+import random
+import threading
+import time
+from datetime import datetime
+
+JITTER = 0.1  # fraction of the interval a run may be moved by
+
+
+class RefreshJob:
+    # One refresh function and what happened the last times it ran
+    def __init__(self, name, func, interval, jitter=JITTER):
+        # initialization of the class
+        self.name = name
+        self.func = func
+        self.interval = interval
+        self.jitter = jitter
+        self.running = threading.Lock()
+        self.runs = 0
+        self.failures = 0
+        self.last_success = None
+        self.last_error = None
+        self.last_duration = None
+
+    def run(self):
+        # run once unless a run is already going, True if it ran
+        if not self.running.acquire(blocking=False):
+            return False
+        try:
+            started = time.monotonic()
+            self.runs += 1
+            try:
+                self.func()
+            except Exception as e:
+                self.failures += 1
+                self.last_error = f'{datetime.now().isoformat(timespec="seconds")}: {e}'
+                print(f'Refresh {self.name} failed: {e}')
+            else:
+                self.last_success = time.time()
+            self.last_duration = time.monotonic() - started
+            return True
+        finally:
+            self.running.release()
+
+    def next_delay(self):
+        spread = self.interval * self.jitter
+        return max(0, self.interval + random.uniform(-spread, spread))
+
+    def status(self):
+        return {
+            'interval': self.interval,
+            'running': self.running.locked(),
+            'runs': self.runs,
+            'failures': self.failures,
+            'last_success': datetime.fromtimestamp(self.last_success).isoformat(timespec='seconds')
+            if self.last_success else None,
+            'last_duration': round(self.last_duration, 3) if self.last_duration is not None else None,
+            'last_error': self.last_error,
+        }
+
+
+class RefreshScheduler:
+    # Runs every job on its own daemon thread until stop() is called
+    def __init__(self):
+        # initialization of the class
+        self.jobs = {}
+        self.threads = []
+        self.stopping = threading.Event()
+
+    def add(self, name, func, interval, jitter=JITTER):
+        self.jobs[name] = RefreshJob(name, func, interval, jitter)
+
+    def start(self):
+        for job in self.jobs.values():
+            thread = threading.Thread(target=self._loop, args=(job,),
+                                      name=f'refresh-{job.name}', daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def stop(self):
+        self.stopping.set()
+        for thread in self.threads:
+            thread.join()
+
+    def run_now(self, name):
+        # refresh one job straight away, False if it was already running
+        return self.jobs[name].run()
+
+    def _loop(self, job):
+        while not self.stopping.is_set():
+            job.run()
+            self.stopping.wait(job.next_delay())
+
+    def status(self):
+        return {name: job.status() for name, job in self.jobs.items()}
@@ -0,0 +1,269 @@
+"""Recorded pages and a local stand-in for the sites the scrapers read
+
+The scrapers fetch cnbc.com and coinranking.com, so their speed could only
+be measured over the network, and never twice the same way. This module
+records the pages once and serves them again from a local HTTP server:
+
+    python scrape_replay.py record fixtures
+    python scrape_replay.py serve --fixtures fixtures --port 8100 --latency 0.05 --failure-rate 0.01
+
+and the server is pointed at it with
+
+    python server.py --stock-url http://127.0.0.1:8100/quotes/ --crypto-url http://127.0.0.1:8100/
+
+record saves the crypto page and the quote page of every ticker in
+ticks.csv, with a manifest.json of which URL path each file answers.
+
+serve answers the recorded paths. A quote page for a ticker that was not
+recorded is one of the recorded quote pages, picked by a hash of the
+path, so any number of tickers can be scraped from a few fixtures.
+Without fixtures it makes up pages with the elements the extractors look
+for, padded with filler before and after the quote to --page-size bytes.
+Every answer can be delayed by --latency seconds (plus up to --jitter
+more), and a share of them fail with 503 (--failure-rate). Pages have an
+ETag, and a request with a matching If-None-Match gets a 304, like the
+real sites.
+"""
+import argparse
+import hashlib
+import json
+import os
+import random
+import sys
+import threading
+import time
+import zlib
+from functools import lru_cache
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit
+
+import requests
+
+# the same pages server.py scrapes by default
+STOCK_BASE_URL = 'https://www.cnbc.com/quotes/'
+CRYPTO_URL = 'https://coinranking.com/'
+QUOTE_PATH = '/quotes/'
+CRYPTO_PATH = '/'
+PAGE_SIZE = 150 * 1024  # about what a recorded quote page weighs
+RECORD_TIMEOUT = 30
+
+STOCK_PAGE = ('<!DOCTYPE html><html><head><meta charset="utf-8"><title>{tick}</title></head>'
+              '<body>{filler}<header><div class="QuoteStrip-container">'
+              '<span class="QuoteStrip-name">{name}</span>'
+              '<div class="QuoteStrip-extendedLastTradeTime">After Hours: Last | {time}</div>'
+              '<div class="QuoteStrip-lastPriceStripContainer">'
+              '<span class="QuoteStrip-lastPrice">{price}</span></div></div></header>'
+              '{filler}</body></html>')
+CRYPTO_PAGE = ('<!DOCTYPE html><html><head><meta charset="utf-8"><title>Coins</title></head>'
+               '<body>{filler}<table>{rows}</table>{filler}</body></html>')
+CRYPTO_ROW = ('<tr><td><a class="profile__name" href="/coin/{i}">{name}</a></td>'
+              '<td><div class="valuta valuta--light">$ {price}</div></td>'
+              '<td><div class="valuta valuta--light">$ {market_cap} billion</div></td></tr>')
+FILLER_ROW = '<div class="row r{i}"><p>Filler paragraph {i} with a <a href="/n/{i}">link</a>.</p></div>\n'
+
+
+@lru_cache(maxsize=8)
+def filler(size):
+    # about size bytes of markup the extractors have to skip
+    rows = []
+    total = 0
+    while total < size:
+        rows.append(FILLER_ROW.format(i=len(rows)))
+        total += len(rows[-1])
+    return ''.join(rows)
+
+
+def synthetic_stock_page(tick, page_size=PAGE_SIZE):
+    price = 10 + int(hashlib.md5(tick.encode()).hexdigest()[:6], 16) % 100000 / 100
+    return STOCK_PAGE.format(tick=tick, name=f'{tick} Inc', time='7:59 PM EDT',
+                             price=f'{price:,.2f}', filler=filler(page_size // 2))
+
+
+def synthetic_crypto_page(page_size=PAGE_SIZE, coins=10):
+    rows = ''.join(CRYPTO_ROW.format(i=i, name=f'Coin {i}', price=f'{1000 + i * 12.5:,.2f}',
+                                     market_cap=f'{i + 0.5}') for i in range(coins))
+    return CRYPTO_PAGE.format(rows=rows, filler=filler(page_size // 2))
+
+
+def read_ticks(path):
+    # tickers of a ticks file like server.py reads them, without the header
+    with open(path, encoding='utf-8-sig') as f:
+        return [tick.strip() for tick in f.readlines()[1:] if tick.strip()]
+
+
+def record(directory, urls, session=None):
+    # save every url into directory and write manifest.json, returns the
+    # manifest {path: {'file', 'url', 'content_type'}}
+    os.makedirs(directory, exist_ok=True)
+    session = session or requests.Session()
+    manifest = {}
+    for number, url in enumerate(urls):
+        response = session.get(url, timeout=RECORD_TIMEOUT)
+        response.raise_for_status()
+        file_name = f'{number}.html'
+        with open(os.path.join(directory, file_name), 'wb') as f:
+            f.write(response.content)
+        manifest[urlsplit(url).path or '/'] = {
+            'file': file_name, 'url': url,
+            'content_type': response.headers.get('Content-Type', 'text/html; charset=utf-8')}
+        print(f'Recorded {url} ({len(response.content)} bytes)')
+    with open(os.path.join(directory, 'manifest.json'), 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=2)
+    return manifest
+
+
+class Page:
+    # body of one answer and its ETag
+    def __init__(self, body, content_type='text/html; charset=utf-8'):
+        # initialization of the class
+        self.body = body if isinstance(body, bytes) else body.encode('utf-8')
+        self.content_type = content_type
+        self.etag = '"%s"' % hashlib.sha1(self.body).hexdigest()
+
+
+class ReplayServer(ThreadingHTTPServer):
+    # Serves recorded or made-up pages, slowly and unreliably on request
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self, address, fixtures=None, latency=0.0, jitter=0.0, failure_rate=0.0,
+                 page_size=PAGE_SIZE, etags=True, seed=0):
+        # initialization of the class
+        self.latency = latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self.page_size = page_size
+        self.etags = etags
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.pages = {}  # path -> Page
+        self.quote_pages = []  # recorded quote pages, reused for other tickers
+        self.served = 0
+        self.failed = 0
+        self.not_modified = 0
+        if fixtures is not None:
+            self.load(fixtures)
+        super().__init__(address, ReplayHandler)
+
+    def load(self, directory):
+        with open(os.path.join(directory, 'manifest.json'), encoding='utf-8') as f:
+            manifest = json.load(f)
+        for path, entry in manifest.items():
+            with open(os.path.join(directory, entry['file']), 'rb') as f:
+                page = Page(f.read(), entry.get('content_type', 'text/html; charset=utf-8'))
+            self.pages[path] = page
+            if path.startswith(QUOTE_PATH):
+                self.quote_pages.append(page)
+
+    def page(self, path):
+        # the page for a path, None for a 404
+        page = self.pages.get(path)
+        if page is not None:
+            return page
+        if path.startswith(QUOTE_PATH) and len(path) > len(QUOTE_PATH):
+            # not kept, thousands of tickers would take that many pages of memory
+            if self.quote_pages:
+                return self.quote_pages[zlib.crc32(path.encode()) % len(self.quote_pages)]
+            return Page(synthetic_stock_page(path[len(QUOTE_PATH):], self.page_size))
+        if path == CRYPTO_PATH:
+            with self.lock:
+                page = self.pages.setdefault(path, Page(synthetic_crypto_page(self.page_size)))
+            return page
+        return None
+
+    def draw(self):
+        # (delay in seconds, whether this answer fails)
+        with self.lock:
+            delay = self.latency + (self.random.uniform(0, self.jitter) if self.jitter else 0.0)
+            return delay, self.random.random() < self.failure_rate
+
+    def count(self, counter):
+        with self.lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def stats(self):
+        with self.lock:
+            return {'served': self.served, 'failed': self.failed,
+                    'not_modified': self.not_modified}
+
+
+class ReplayHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # keep-alive, like the real sites
+
+    def do_GET(self):
+        server = self.server
+        delay, fail = server.draw()
+        if delay > 0:
+            time.sleep(delay)
+        page = server.page(urlsplit(self.path).path)
+        if fail:
+            server.count('failed')
+            self.answer(503, b'Service Unavailable', 'text/plain')
+        elif page is None:
+            self.answer(404, b'Not Found', 'text/plain')
+        elif server.etags and self.headers.get('If-None-Match') == page.etag:
+            server.count('not_modified')
+            self.answer(304, b'', page.content_type, page.etag)
+        else:
+            server.count('served')
+            self.answer(200, page.body, page.content_type, page.etag if server.etags else None)
+
+    def answer(self, status, body, content_type, etag=None):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        if etag is not None:
+            self.send_header('ETag', etag)
+        if status != 304:
+            self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if status != 304:
+            self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # one line per page would drown the benchmark output
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Record pages, or serve them to the scrapers')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    record_parser = commands.add_parser('record', help='save the pages the scrapers read')
+    record_parser.add_argument('directory')
+    record_parser.add_argument('--ticks', default='ticks.csv', help='tickers to record')
+    record_parser.add_argument('--stock-url', default=STOCK_BASE_URL)
+    record_parser.add_argument('--crypto-url', default=CRYPTO_URL)
+
+    serve_parser = commands.add_parser('serve', help='answer the scrapers locally')
+    serve_parser.add_argument('--fixtures', help='directory written by record (default: made-up pages)')
+    serve_parser.add_argument('--host', default='127.0.0.1')
+    serve_parser.add_argument('--port', type=int, default=8100)
+    serve_parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every answer')
+    serve_parser.add_argument('--jitter', type=float, default=0.0, help='up to this many seconds more')
+    serve_parser.add_argument('--failure-rate', type=float, default=0.0, help='share of 503 answers')
+    serve_parser.add_argument('--page-size', type=int, default=PAGE_SIZE, help='bytes of a made-up page')
+    serve_parser.add_argument('--no-etag', action='store_true', help='never answer 304')
+    serve_parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    if args.command == 'record':
+        try:
+            urls = [args.crypto_url] + [args.stock_url + tick for tick in read_ticks(args.ticks)]
+            record(args.directory, urls)
+        except (OSError, requests.exceptions.RequestException) as e:
+            sys.exit(f'record failed: {e}')
+        return
+
+    server = ReplayServer((args.host, args.port), args.fixtures, args.latency, args.jitter,
+                          args.failure_rate, args.page_size, not args.no_etag, args.seed)
+    print(f'Serving on http://{args.host}:{server.server_address[1]}/', flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print(f'Stats: {server.stats()}')
+
+
+if __name__ == '__main__':
+    main()
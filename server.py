@@ -2,22 +2,80 @@
 import sqlite3
 import socket
 import threading
+import asyncio
+import argparse
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager
 import requests
-from bs4 import BeautifulSoup
 import csv
 import logging
-import re
+import time
+from urllib.parse import urlsplit
+import json
+import pandas as pd
+from db_pool import get_pool
+from migrations import migrate
+from ledger import get_writer
+from cache import AccountCache
+from http_cache import HTTPCache
+from scheduler import RefreshScheduler
+from quotes import QuoteStore, STOCKS, CRYPTO, parse_price
+from streaming import QuoteBroadcaster
+from price_history import PriceHistory
+from valuation import (POSITION_COLUMNS, load_positions, revalue,
+                       to_records)
+from extractors import DEFAULT_BACKEND, extract_stock, extract_crypto
+from protocol import (encode_frame, recv_frame, read_frame, send_frame,
+                      split_request, split_command, make_response)
 
 # Defining the Host and Port to make connection
 HOST = '127.0.0.1'
 PORT = 8000
 
+# sqlite database file used by the server
+DATABASE = 'users.db'
+
+# Number of threads that run the blocking database work for the asyncio server
+DB_WORKERS = 8
+# Requests one connection may have running at once before we stop reading it
+MAX_IN_FLIGHT = 64
+
+# Stock scraping: pages fetched at once, at most this many at a time from
+# one host, seconds between two requests to one host, request timeout
+SCRAPE_WORKERS = 8
+SCRAPE_PER_HOST = 8
+SCRAPE_DELAY = 0.0
+SCRAPE_TIMEOUT = 10
+SCRAPE_BACKEND = DEFAULT_BACKEND  # page parser, see extractors.py
+# Where the pages come from; point these at scrape_replay.py to scrape offline
+STOCK_BASE_URL = 'https://www.cnbc.com/quotes/'  # + ticker
+CRYPTO_URL = 'https://coinranking.com/'
+
+# Scraped pages: cache file and seconds a page is reused without asking again
+HTTP_CACHE_FILE = 'http_cache.db'
+HTTP_CACHE_TTL = 0
+
+# Directory of the price history files
+HISTORY_DIR = 'price_history'
+
+# Seconds between background refreshes of the stock and crypto data
+STOCK_REFRESH_INTERVAL = 15 * 60
+CRYPTO_REFRESH_INTERVAL = 5 * 60
+
+# Transactions per get_transactions page by default and at most, and per
+# frame of the streamed answer
+TRANSACTION_PAGE = 100
+MAX_TRANSACTION_PAGE = 1000
+TRANSACTION_CHUNK = 50
+
+# How the batch action treats a failing command, see run_batch
+BATCH_MODES = ('atomic', 'best_effort')
+
 # This fucntion will create databse and the tables when you run the server side of the code
 
 
-def create_database_and_tables():
-    conn = sqlite3.connect('users.db')  # making connecting with user.db
+def create_database_and_tables(database=None):
+    conn = get_pool(database or DATABASE).get()  # making connecting with user.db
     c = conn.cursor()  # setting the cursor
 
     # creating a table for user to store username and passsword data
@@ -49,18 +107,16 @@ def create_database_and_tables():
                   market TEXT,
                   timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
                   FOREIGN KEY (username) REFERENCES users(username))''')
+    conn.commit()
 
-    conn.close()  # closing the connection with database
-
-
-# calling the fucntion
-create_database_and_tables()
+    migrate(conn)  # indexes and other changes to existing tables
 
 
 @contextmanager  # allocate and release resources precisely when you want to
 # to manage the opening and closing of a connection
-def db_connection(database='users.db'):
-    conn = sqlite3.connect(database)
+def db_connection(database=None):
+    # the connection comes from the pool and stays open for the next call
+    conn = get_pool(database or DATABASE).get()
     cursor = conn.cursor()
     try:
         yield conn, cursor
@@ -68,111 +124,444 @@ def db_connection(database='users.db'):
         conn.rollback()
         raise e
     finally:
-        conn.close()
+        cursor.close()
+        if conn.in_transaction:
+            # anything not committed is thrown away, like closing used to do
+            conn.rollback()
+
+
+def dispatch(request):
+    # run one '|' separated command and return the response text
+    try:
+        command = ledger_command(request)
+    except BatchError as e:
+        return _batch_response(None, e)
+    if command is not None:  # balance changes go through the ledger writer
+        respond, func, args = command
+        return ledger_call(respond, func, *args)
+
+    action = request[0]
+
+    if action == 'login':  # perform when user try to login
+        username = request[1]
+        password = request[2]
+        return authenticate(username, password)
+
+    elif action == 'register':  # perform when user try to register
+        username = request[1]
+        password = request[2]
+        return register_user(username, password)
+
+    elif action == 'get_balance':  # feth the amount from the client side
+        username = request[1]
+        return str(get_balance(username))
+
+    elif action == 'get_portfolio':  # balance and positions as JSON
+        username = request[1]
+        return get_portfolio(username)
+
+    elif action == 'get_valuation':  # market value and P&L of one user's positions
+        username = request[1]
+        return get_valuation(username)
+
+    elif action == 'revalue':  # mark every portfolio to market, totals only
+        return revalue_portfolios()
+
+    elif action == 'cache_stats':  # hit/miss counters of the account cache
+        return json.dumps(account_cache.stats())
+
+    elif action == 'get_transactions':  # get_transactions|username|limit|cursor|type|market
+        username = request[1]
+        limit = int(request[2]) if len(request) > 2 and request[2] else TRANSACTION_PAGE
+        cursor = request[3] if len(request) > 3 and request[3] else None
+        transaction_type = request[4] if len(request) > 4 and request[4] else None
+        market = request[5] if len(request) > 5 and request[5] else None
+        return get_transactions(username, limit, cursor, transaction_type, market)
+
+    elif action == 'get_quotes':  # latest prices, get_quotes|since|symbol|...
+        since = int(request[1]) if len(request) > 1 and request[1] else 0
+        symbols = request[2:] or None
+        return json.dumps(quote_store.snapshot(symbols, since))
+
+    elif action == 'get_history':  # get_history|symbol|start|end|points
+        symbol = request[1]
+        start = float(request[2]) if len(request) > 2 and request[2] else None
+        end = float(request[3]) if len(request) > 3 and request[3] else None
+        points = int(request[4]) if len(request) > 4 and request[4] else None
+        return get_history(symbol, start, end, points)
+
+    elif action == 'refresh_status':  # when the market data was last refreshed
+        return json.dumps(refresh_scheduler.status())
+
+    return f'Unknown action: {action}'
+
+
+def ledger_command(request):
+    # turn a ledger command into (respond, func, args), None for any other
+    # action. func(cursor, *args) runs in the ledger writer and
+    # respond(result, error) turns its outcome into the response text
+    action = request[0]
+
+    if action == 'deposit':  # perform when user try deposit money in the account
+        username = request[1]
+        amount = float(request[2])
+        return _deposit_response, _deposit, (username, amount)
+
+    elif action == 'invest':  # perform when user try to invest
+        username = request[1]
+        market = request[2]
+        quantity = int(request[3])
+        amount = float(request[4])
+        transaction_type = request[5]
+        return _invest_response, _invest, (username, market, quantity, amount, transaction_type)
+
+    elif action == 'withdraw':  # perform when user try to withdraw money from account
+        username = request[1]
+        amount = float(request[2])
+        return _withdraw_response, _withdraw_money, (username, amount)
+
+    elif action == 'sell_stock':  # perform when user make any sell from the portfolio
+        username, stock, amount = request[1], request[2], int(request[3])
+        return _sell_stock_response, _sell_stock, (username, stock, amount)
+
+    elif action == 'batch':  # many ledger commands in one transaction
+        # batch|mode|["deposit|user|10", "invest|user|...", ...]
+        # the list is JSON, joined back in case a client did not escape its '|'.
+        # A malformed batch is refused here and never reaches the writer
+        if len(request) < 3:
+            raise BatchError('A batch needs a mode and a JSON list of commands.')
+        mode = request[1]
+        try:
+            commands = json.loads('|'.join(request[2:]))
+        except ValueError as e:
+            raise BatchError(f'Commands are not valid JSON: {e}')
+        if not isinstance(commands, list) or not all(isinstance(command, str) for command in commands):
+            raise BatchError('Commands must be a JSON list of strings.')
+        return _batch_response, _run_batch, (commands, mode)
+
+    return None
+
+
+def ledger_writer():
+    return get_writer(DATABASE, commit_hooks=[_refresh_accounts])
+
+
+def _touched_users(func, args):
+    # usernames a committed ledger command may have changed. A batch
+    # command that cannot be read was refused, so it changed nobody
+    if func is not _run_batch:
+        return {args[0]}
+    usernames = set()
+    for command in args[0]:
+        fields = split_command(command) if isinstance(command, str) else []
+        if len(fields) > 1:
+            usernames.add(fields[1])
+    return usernames
+
+
+def _refresh_accounts(conn, committed):
+    # ledger commit hook, keeps the account cache in step with the database.
+    # An account that cannot be reloaded is dropped from the cache, so the
+    # next read goes to disk; the other accounts are still refreshed
+    usernames = set()
+    for func, args in committed:
+        usernames |= _touched_users(func, args)
+    cursor = conn.cursor()
+    try:
+        for username in usernames:
+            try:
+                account_cache.refresh(
+                    username, lambda: _load_account(cursor, username))
+            except Exception as e:
+                print(f'Could not refresh the cached account of {username}: {e}')
+                account_cache.invalidate(username)
+    finally:
+        cursor.close()
+
+
+def ledger_call(respond, func, *args):
+    # run a ledger command and wait until it is committed
+    try:
+        result = ledger_writer().execute(func, *args)
+    except Exception as e:
+        return respond(None, e)
+    return respond(result, None)
+
+
+class StreamedResponse(list):
+    # An answer sent as several frames with the same request id, one per
+    # item. Each item is JSON with 'more' telling whether another follows
+    pass
+
+
+def make_responses(request_id, response):
+    # the framed responses for one answer, usually just one
+    if isinstance(response, StreamedResponse):
+        return [make_response(request_id, part) for part in response]
+    return [make_response(request_id, response)]
+
+
+def handle_request(text):
+    # run one framed request and build the framed responses for it
+    request_id, request = split_request(text)
+    try:
+        response = dispatch(request)
+    except Exception as e:
+        # a bad command only fails that request, not the whole connection
+        response = f'Error: {e}'
+    return make_responses(request_id, response)
+
+
+def is_stream_request(request):
+    # subscribe|symbol|... and unsubscribe|subscribe request id need the
+    # connection itself, so the client handlers deal with them
+    return request[0] in ('subscribe', 'unsubscribe')
+
+
+# answer to an unsubscribe without an id, the connection stays open
+UNSUBSCRIBE_ERROR = 'Error: unsubscribe needs the request id of a subscribe'
 
 
 def handle_client(conn, addr):
     # handel the client side of the requests
+    send_lock = threading.Lock()  # subscriptions send from their own threads
+    subscriptions = {}  # subscribe request id -> (subscription, wake up event)
+
+    def send(text):
+        with send_lock:
+            send_frame(conn, text)
+
+    def pump(request_id, subscription, wake_up):
+        # send a subscription's updates until it is closed
+        try:
+            while not subscription.closed:
+                wake_up.wait()
+                wake_up.clear()
+                message = subscription.take(quote_store)
+                while message is not None and not subscription.closed:
+                    send(make_response(request_id, message))
+                    message = subscription.take(quote_store)
+        except OSError:
+            pass  # the client went away, the main loop cleans up
+
     try:
         with conn:
             print(f'Connected with {addr}')
             while True:
-                data = conn.recv(1024)
-                if not data:
+                text = recv_frame(conn)
+                if text is None:
                     break
-                request = data.decode().split('|')
-                action = request[0]
-
-                if action == 'login':  # perform when user try to login
-                    username = request[1]
-                    password = request[2]
-                    conn.sendall(authenticate(username, password).encode())
-
-                elif action == 'register':  # perform when user try to register
-                    username = request[1]
-                    password = request[2]
-                    conn.sendall(register_user(username, password).encode())
-
-                elif action == 'deposit':  # perform when user try deposit money in the account
-                    username = request[1]
-                    amount = float(request[2])
-                    response = deposit(username, amount)
-                    conn.sendall(response.encode())
-
-                elif action == 'get_balance':  # feth the amount from the client side
-                    username = request[1]
-                    conn.sendall(str(get_balance(username)).encode())
-
-                elif action == 'invest':  # perform when user try to invest
-                    username = request[1]
-                    market = request[2]
-                    quantity = int(request[3])
-                    amount = float(request[4])
-                    transaction_type = request[5]
-                    response = invest(username, market,
-                                      quantity, amount, transaction_type)
-                    conn.sendall(response.encode())
-
-                elif action == 'withdraw':  # perform when user try to withdraw money from account
-                    username = request[1]
-                    amount = float(request[2])
-                    response = withdraw_money(username, amount)
-                    conn.sendall(response.encode())
-
-                elif action == 'sell_stock':  # perform when user make any sell from the portfolio
-                    username, stock, amount = request[1], request[2], int(
-                        request[3])
-                    response = sell_stock(username, stock, amount)
-                    conn.sendall(str(response).encode())
+                request_id, request = split_request(text)
+                if request[0] == 'subscribe':
+                    wake_up = threading.Event()
+                    subscription = quote_broadcaster.subscribe(
+                        request[1:], wake_up.set)
+                    subscriptions[request_id] = (subscription, wake_up)
+                    threading.Thread(target=pump, args=(request_id, subscription, wake_up),
+                                     daemon=True).start()
+                elif request[0] == 'unsubscribe' and len(request) < 2:
+                    send(make_response(request_id, UNSUBSCRIBE_ERROR))
+                elif request[0] == 'unsubscribe':
+                    stream = subscriptions.pop(request[1], None)
+                    if stream is not None:
+                        quote_broadcaster.unsubscribe(stream[0])
+                        stream[1].set()
+                    send(make_response(request_id, 'Unsubscribed' if stream else 'No such subscription'))
+                else:
+                    for response in handle_request(text):
+                        send(response)
     except Exception as e:
         # to print the error if there is any
         print(f"Error handling client {addr}: {e}")
     finally:
+        for subscription, wake_up in subscriptions.values():
+            quote_broadcaster.unsubscribe(subscription)
+            wake_up.set()
         print(f'Disconnected from {addr}')  # disconnects from the client side
 
 
+async def handle_request_async(text, executor):
+    # like handle_request, but a ledger command waits for the writer without
+    # holding one of the executor threads, so many can be in one commit
+    request_id, request = split_request(text)
+    try:
+        command = ledger_command(request)
+        if command is None:
+            loop = asyncio.get_running_loop()
+            response = await loop.run_in_executor(executor, dispatch, request)
+        else:
+            respond, func, args = command
+            try:
+                result = await asyncio.wrap_future(ledger_writer().submit(func, *args))
+            except Exception as e:
+                response = respond(None, e)
+            else:
+                response = respond(result, None)
+    except BatchError as e:
+        response = _batch_response(None, e)
+    except Exception as e:
+        response = f'Error: {e}'
+    return make_responses(request_id, response)
+
+
+async def handle_client_async(reader, writer, executor):
+    # asyncio version of handle_client, the blocking database work
+    # is handed to the executor so the event loop never waits on sqlite.
+    # Requests are run as they arrive and answered as soon as they finish,
+    # so a client can pipeline commands and match answers by request id
+    addr = writer.get_extra_info('peername')
+    loop = asyncio.get_running_loop()
+    in_flight = asyncio.Semaphore(MAX_IN_FLIGHT)
+    write_lock = asyncio.Lock()
+    tasks = set()
+    subscriptions = {}  # subscribe request id -> (subscription, pump task)
+
+    async def send(text):
+        async with write_lock:
+            writer.write(encode_frame(text))
+            await writer.drain()
+
+    async def run(text):
+        try:
+            for response in await handle_request_async(text, executor):
+                await send(response)  # drains, so a long answer waits for the client
+        finally:
+            in_flight.release()
+
+    async def pump(request_id, subscription, wake_up):
+        # send a subscription's updates; a slow client only holds up this
+        # task while its pending quotes keep being merged
+        while not subscription.closed:
+            await wake_up.wait()
+            wake_up.clear()
+            message = subscription.take(quote_store)
+            while message is not None and not subscription.closed:
+                await send(make_response(request_id, message))
+                message = subscription.take(quote_store)
+
+    def stream(text):
+        request_id, request = split_request(text)
+        if request[0] == 'subscribe':
+            wake_up = asyncio.Event()
+            subscription = quote_broadcaster.subscribe(
+                request[1:], lambda: loop.call_soon_threadsafe(wake_up.set))
+            subscriptions[request_id] = (subscription, asyncio.create_task(
+                pump(request_id, subscription, wake_up)))
+            return None
+        if len(request) < 2:
+            return make_response(request_id, UNSUBSCRIBE_ERROR)
+        found = subscriptions.pop(request[1], None)
+        if found is not None:
+            quote_broadcaster.unsubscribe(found[0])
+            found[1].cancel()
+        return make_response(request_id, 'Unsubscribed' if found else 'No such subscription')
+
+    try:
+        print(f'Connected with {addr}')
+        while True:
+            text = await read_frame(reader)
+            if text is None:
+                break
+            if is_stream_request(split_request(text)[1]):
+                response = stream(text)
+                if response is not None:
+                    await send(response)
+                continue
+            await in_flight.acquire()  # stop reading when a client has too many queued
+            task = asyncio.create_task(run(text))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
+    except Exception as e:
+        print(f"Error handling client {addr}: {e}")
+    finally:
+        for subscription, task in subscriptions.values():
+            quote_broadcaster.unsubscribe(subscription)
+            task.cancel()
+        writer.close()
+        print(f'Disconnected from {addr}')
+
+
+class LedgerError(Exception):
+    # raised when a ledger command is refused, e.g. not enough funds,
+    # so the caller can roll back or report it
+    pass
+
+
+class BatchError(LedgerError):
+    # raised by ledger_command for a batch that cannot be run at all
+    pass
+
+
+def _deposit(cursor, username, amount):
+    # deposit on an open cursor, the caller commits
+    if amount <= 0:
+        raise LedgerError('Deposit amount must be positive.')
+    cursor.execute(
+        "UPDATE users SET balance = balance + ? WHERE username = ?", (amount, username))
+    if cursor.rowcount == 0:
+        raise LedgerError('User not found.')
+    cursor.execute("INSERT INTO transactions (username, transaction_type, amount) VALUES (?, 'deposit', ?)",
+                   (username, amount))
+    return 'Deposit successful.'
+
+
+def _deposit_response(result, error):
+    if error is None:
+        return result
+    if isinstance(error, LedgerError):
+        return str(error)
+    print(f"An error occurred during the deposit operation: {error}")
+    return 'Error processing the deposit.'
+
+
 def deposit(username, amount):
     # Function to deposit  money
+    return ledger_call(_deposit_response, _deposit, username, amount)
+
+
+def _withdraw_money(cursor, username, amount):
+    # withdraw on an open cursor, the caller commits
     if amount <= 0:
-        return 'Deposit amount must be positive.'
-    try:
-        with db_connection() as (conn, db):  # make connection, execute and then commit the changes
-            db.execute(
-                "UPDATE users SET balance = balance + ? WHERE username = ?", (amount, username))
-            conn.commit()
-            return 'Deposit successful.'
-    except Exception as e:
-        print(f"An error occurred during the deposit operation: {e}")
-        return 'Error processing the deposit.'
+        raise LedgerError('Withdrawal amount must be positive')
+    cursor.execute(
+        "SELECT balance FROM users WHERE username = ?", (username,))
+    row = cursor.fetchone()
+    if row is None:
+        raise LedgerError('User not found.')
+    balance = row[0]
+    if balance < amount:
+        raise LedgerError('Insufficient funds')
+    cursor.execute(
+        "UPDATE users SET balance = balance - ? WHERE username = ?", (amount, username))
+    # update the amount in the table
+    cursor.execute("INSERT INTO transactions (username, transaction_type, amount) VALUES (?, 'withdraw', ?)",
+                   (username, amount))
+    return 'Withdrawal successful'
+
+
+def _withdraw_response(result, error):
+    if error is None:
+        return result
+    if isinstance(error, LedgerError):
+        return str(error)
+    if isinstance(error, sqlite3.Error):
+        return f'Database error during withdrawal: {error}'
+    raise error
 
 
 def withdraw_money(username, amount):
     # Function to withdraw money
-    if amount <= 0:
-        return 'Withdrawal amount must be positive'
-    try:
-        with db_connection() as db:  # make connection with db
-            db.execute(
-                "SELECT balance FROM accounts WHERE username = ?", (username,))
-            balance = db.fetchone()[0]
-            if balance < amount:
-                return 'Insufficient funds'
-            db.execute(
-                "UPDATE accounts SET balance = balance - ? WHERE username = ?", (amount, username))
-            # update the amount in the table
-            return 'Withdrawal successful'
-    except sqlite3.Error as e:
-        return f'Database error during withdrawal: {e}'
+    return ledger_call(_withdraw_response, _withdraw_money, username, amount)
 
 
 def authenticate(username, password):
     # Function to perform authentication
-    conn = sqlite3.connect('users.db')
-    c = conn.cursor()
-    c.execute("SELECT client_id FROM users WHERE username=? AND password=?",
-              (username, password))
-    result = c.fetchone()  # API to fetch the data and comapre
-    conn.close()
+    with db_connection() as (conn, c):
+        c.execute("SELECT client_id FROM users WHERE username=? AND password=?",
+                  (username, password))
+        result = c.fetchone()  # API to fetch the data and comapre
     if result:
         client_id = result[0]
         return f'Login successful, Client ID: {client_id}'
@@ -182,110 +571,316 @@ def authenticate(username, password):
 
 def register_user(username, password):
     # Function to register a new user
-    conn = sqlite3.connect('users.db')
-    c = conn.cursor()
     try:  # conditon to check if username is already in db
-        c.execute("INSERT INTO users (username, password) VALUES (?, ?)",
-                  (username, password))
-        conn.commit()
-        c.execute("SELECT client_id FROM users WHERE username=?", (username,))
-        client_id = c.fetchone()[0]
-        return f'Registration successful, Client ID: {client_id}'
+        with db_connection() as (conn, c):
+            c.execute("INSERT INTO users (username, password) VALUES (?, ?)",
+                      (username, password))
+            client_id = c.lastrowid
+            conn.commit()
+            return f'Registration successful, Client ID: {client_id}'
     except sqlite3.IntegrityError:
         return 'Username already exists'
-    finally:
-        conn.close()
+
+
+def _load_account(cursor, username):
+    # balance and positions of one account, None if there is no such user
+    cursor.execute("SELECT balance FROM users WHERE username = ?", (username,))
+    row = cursor.fetchone()
+    if row is None:
+        return None
+    cursor.execute("""SELECT market, SUM(quantity), SUM(amount) FROM portfolios
+                      WHERE username = ? GROUP BY market""", (username,))
+    positions = {market: {'quantity': quantity, 'amount': amount}
+                 for market, quantity, amount in cursor.fetchall()}
+    return {'balance': row[0], 'positions': positions}
+
+
+def load_account(username):
+    with db_connection() as (conn, c):
+        return _load_account(c, username)
+
+
+# balances and positions of recently used accounts, see cache.py
+account_cache = AccountCache(load_account)
 
 
 def get_balance(username):
-    # Function to get balance from db
-    conn = sqlite3.connect('users.db')
-    c = conn.cursor()
-    c.execute("SELECT balance FROM users WHERE username = ?", (username,))
-    balance = c.fetchone()[0]
-    conn.close()
-    return balance
+    # Function to get balance, from memory once the account is cached
+    account = account_cache.get(username)
+    if account is None:
+        return 'Unknown user'
+    return account['balance']
+
+
+def get_portfolio(username):
+    # Function to get balance and positions, {'balance', 'positions'} where
+    # positions maps a market to its quantity and amount paid
+    account = account_cache.get(username)
+    if account is None:
+        return 'Unknown user'
+    return json.dumps(account)
+
+
+def get_history(symbol, start=None, end=None, points=None):
+    # Function to get a symbol's scraped prices between start and end, as
+    # JSON {'symbol', 'times', 'prices'}. With points, long ranges are thinned
+    # to about that many evenly spaced prices, enough for a chart
+    times, prices = get_price_history().range(symbol, start, end)
+    if points and len(times) > points:
+        step = -(-len(times) // points)
+        times, prices = times[::step], prices[::step]
+    return json.dumps({'symbol': symbol, 'times': times.tolist(), 'prices': prices.tolist()})
+
+
+def get_transactions(username, limit=TRANSACTION_PAGE, cursor=None,
+                     transaction_type=None, market=None):
+    # Function to page through a user's transactions, newest first. cursor
+    # is the 'next' of the previous page: the page starts after that
+    # (timestamp, id), found in the index instead of skipping rows, so
+    # every page costs the same however deep it is. The page is sent in
+    # parts of TRANSACTION_CHUNK transactions:
+    # {'transactions': [...], 'next': cursor or None, 'more': bool}
+    limit = max(1, min(limit, MAX_TRANSACTION_PAGE))
+    conditions = ['username = ?']
+    params = [username]
+    if transaction_type is not None:
+        conditions.append('transaction_type = ?')
+        params.append(transaction_type)
+    if market is not None:
+        conditions.append('market = ?')
+        params.append(market)
+    if cursor is not None:
+        timestamp, row_id = cursor.rsplit(',', 1)
+        conditions.append('(timestamp, id) < (?, ?)')
+        params += [timestamp, int(row_id)]
+    with db_connection() as (conn, c):
+        c.execute(f"""SELECT id, transaction_type, amount, market, timestamp FROM transactions
+                      WHERE {' AND '.join(conditions)}
+                      ORDER BY timestamp DESC, id DESC LIMIT ?""", params + [limit + 1])
+        rows = c.fetchall()
+    next_cursor = f'{rows[limit - 1][4]},{rows[limit - 1][0]}' if len(rows) > limit else None
+    transactions = [{'id': row_id, 'type': kind, 'amount': amount, 'market': row_market,
+                     'timestamp': timestamp}
+                    for row_id, kind, amount, row_market, timestamp in rows[:limit]]
+    chunks = [transactions[i:i + TRANSACTION_CHUNK]
+              for i in range(0, len(transactions), TRANSACTION_CHUNK)] or [[]]
+    return StreamedResponse(
+        json.dumps({'transactions': chunk, 'next': next_cursor, 'more': i < len(chunks) - 1})
+        for i, chunk in enumerate(chunks))
+
+
+def get_valuation(username):
+    # Function to value a user's positions at the latest prices, as JSON
+    # {'positions': [{market, quantity, amount, price, value, pnl}],
+    #  'totals': {positions, cost, value, pnl, unpriced}}
+    account = account_cache.get(username)
+    if account is None:
+        return 'Unknown user'
+    positions = pd.DataFrame(
+        [(username, market, position['quantity'], position['amount'])
+         for market, position in account['positions'].items()],
+        columns=POSITION_COLUMNS)
+    valued, totals = revalue(positions, quote_store.prices())
+    if totals.empty:
+        totals = {'positions': 0, 'cost': 0.0, 'value': 0.0, 'pnl': 0.0, 'unpriced': 0}
+    else:
+        totals = to_records(totals)[0]
+    return json.dumps({'positions': to_records(valued.drop(columns='username')),
+                       'totals': totals})
+
+
+def revalue_portfolios():
+    # Function to value every portfolio at the latest prices, e.g. at the
+    # end of the day. Answers with the totals over all users as JSON
+    started = time.perf_counter()
+    with db_connection() as (conn, c):
+        positions = load_positions(c)
+    valued, totals = revalue(positions, quote_store.prices())
+    return json.dumps({
+        'users': len(totals),
+        'positions': len(valued),
+        'cost': float(totals['cost'].sum()),
+        'value': float(totals['value'].sum()),
+        'pnl': float(totals['pnl'].sum()),
+        'unpriced': int(totals['unpriced'].sum()),
+        'seconds': round(time.perf_counter() - started, 3),
+    })
+
+
+def _invest(cursor, username, market, quantity, amount, transaction_type):
+    # investment on an open cursor, the caller commits. Markets the quote
+    # store knows are priced by the server, amount is only used for others
+    price = quote_store.price(market)
+    if price is not None:
+        amount = price * quantity
+    cursor.execute(
+        "SELECT balance FROM users WHERE username = ?", (username,))
+    balance_result = cursor.fetchone()
+    if not balance_result or balance_result[0] < amount:
+        raise LedgerError('Insufficient funds')
+    cursor.execute(
+        "UPDATE users SET balance = balance - ? WHERE username = ?", (amount, username))
+    # one row per position, buying more of a market adds to it
+    cursor.execute("""INSERT INTO portfolios (username, market, quantity, amount) VALUES (?, ?, ?, ?)
+                      ON CONFLICT (username, market) DO UPDATE
+                      SET quantity = quantity + excluded.quantity, amount = amount + excluded.amount""",
+                   (username, market, quantity, amount))
+    cursor.execute("INSERT INTO transactions (username, transaction_type, amount, market) VALUES (?, ?, ?, ?)",
+                   (username, transaction_type, amount, market))
+    return 'Investment successful'
+
+
+def _invest_response(result, error):
+    if error is None:
+        return result
+    if isinstance(error, LedgerError):
+        return str(error)
+    print(f"Error during investment: {error}")
+    return f'Error during investment: {error}'
 
 
 def invest(username, market, quantity, amount, transaction_type):
     # Function when user try to invest stocks/crypto
-    try:
-        with db_connection() as (conn, cursor):
-            cursor.execute(
-                "SELECT balance FROM users WHERE username = ?", (username,))
-            balance_result = cursor.fetchone()
-            if balance_result and balance_result[0] >= amount:
-                cursor.execute(
-                    "UPDATE users SET balance = balance - ? WHERE username = ?", (amount, username))
-                cursor.execute("INSERT INTO portfolios (username, market, quantity, amount) VALUES (?, ?, ?, ?)",
-                               (username, market, quantity, amount))
-                cursor.execute("INSERT INTO transactions (username, transaction_type, amount, market) VALUES (?, ?, ?, ?)",
-                               (username, transaction_type, amount, market))
-                conn.commit()
-                return 'Investment successful'
-            else:
-                return 'Insufficient funds'
-    except Exception as e:
-        print(f"Error during investment: {e}")
-        return f'Error during investment: {e}'
+    return ledger_call(_invest_response, _invest, username, market,
+                       quantity, amount, transaction_type)
+
+
+def _sell_stock(cursor, username, stock, amount):
+    # sale on an open cursor, the caller commits. amount is the quantity
+    # sold, at the price in the quote store
+    stock_price = quote_store.price(stock)
+    if stock_price is None:
+        raise LedgerError('Invalid stock.')
+
+    cursor.execute(
+        "SELECT quantity, amount FROM portfolios WHERE username=? AND market=?", (username, stock))
+    result = cursor.fetchone()
+    if not result or result[0] < amount:
+        raise LedgerError('Not enough stock to sell.')
+    quantity, cost = result
+    new_quantity = quantity - amount
+    if new_quantity > 0:
+        # what is left keeps its share of the purchase cost
+        cursor.execute("UPDATE portfolios SET quantity=?, amount=? WHERE username=? AND market=?",
+                       (new_quantity, cost * new_quantity / quantity, username, stock))
+    else:
+        cursor.execute(
+            "DELETE FROM portfolios WHERE username=? AND market=?", (username, stock))
+
+    total_gain = stock_price * amount
+    cursor.execute("UPDATE users SET balance = balance + ? WHERE username=?",
+                   (total_gain, username))
+    cursor.execute("INSERT INTO transactions (username, transaction_type, amount, market) VALUES (?, ?, ?, ?)",
+                   (username, 'sell', total_gain, stock))
+    return 'Stock sold successfully.'
+
+
+def _sell_stock_result(result, error):
+    if error is None:
+        return {"status": "success", "message": result}
+    if isinstance(error, LedgerError):
+        return {"status": "failure", "message": str(error)}
+    raise error
+
+
+def _sell_stock_response(result, error):
+    return json.dumps(_sell_stock_result(result, error))
 
 
 def sell_stock(username, stock, amount):
     # Function when user try to sell stocks/crypto
-    conn = sqlite3.connect('users.db')
-    try:
-        c = conn.cursor()
+    return ledger_call(_sell_stock_result, _sell_stock, username, stock, amount)
 
-        c.execute("SELECT price FROM stocks WHERE stock=?", (stock,))
-        result = c.fetchone()
-        if result:
-            stock_price = result[0]
-        else:
-            return {"status": "failure", "message": "Invalid stock."}
-
-        c.execute(
-            "SELECT quantity FROM investments WHERE username=? AND stock=?", (username, stock))
-        result = c.fetchone()
-        if result and result[0] >= amount:
-            new_quantity = result[0] - amount
-            if new_quantity > 0:
-                c.execute("UPDATE investments SET quantity=? WHERE username=? AND stock=?",
-                          (new_quantity, username, stock))
-            else:
-                c.execute(
-                    "DELETE FROM investments WHERE username=? AND stock=?", (username, stock))
 
-            total_gain = stock_price * amount
-            c.execute("UPDATE users SET balance = balance + ? WHERE username=?",
-                      (total_gain, username))
-            conn.commit()
-            return {"status": "success", "message": "Stock sold successfully."}
-        else:
-            return {"status": "failure", "message": "Not enough stock to sell."}
-    finally:
-        conn.close()
+def run_ledger_command(cursor, request):
+    # run one '|' separated ledger command of a batch on an open cursor
+    command = ledger_command(request)
+    if command is None or command[1] is _run_batch:
+        raise LedgerError(f'Action not allowed in a batch: {request[0]}')
+    _, func, args = command
+    return func(cursor, *args)
+
+
+def _run_batch(cursor, commands, mode):
+    # Run many ledger commands on one cursor. The ledger writer already
+    # wraps this in a transaction, so a bulk load costs one commit.
+    # 'atomic'      - every command succeeds or nothing is saved
+    # 'best_effort' - failed commands are skipped, the rest are saved
+    if mode not in BATCH_MODES:
+        return json.dumps({'status': 'failure', 'error': f'Unknown batch mode: {mode}', 'results': []})
+
+    results = []
+    if mode == 'atomic':
+        cursor.execute('SAVEPOINT batch')
+        for command in commands:
+            try:
+                results.append(
+                    {'ok': True, 'response': run_ledger_command(cursor, split_command(command))})
+            except Exception as e:
+                cursor.execute('ROLLBACK TO SAVEPOINT batch')
+                cursor.execute('RELEASE SAVEPOINT batch')
+                results.append({'ok': False, 'error': str(e)})
+                return json.dumps({'status': 'failure', 'failed_index': len(results) - 1,
+                                   'results': results})
+        cursor.execute('RELEASE SAVEPOINT batch')
+    else:
+        for command in commands:
+            cursor.execute('SAVEPOINT batch_item')
+            try:
+                response = run_ledger_command(cursor, split_command(command))
+                cursor.execute('RELEASE SAVEPOINT batch_item')
+                results.append({'ok': True, 'response': response})
+            except Exception as e:
+                # undo only this command and carry on with the rest
+                cursor.execute('ROLLBACK TO SAVEPOINT batch_item')
+                cursor.execute('RELEASE SAVEPOINT batch_item')
+                results.append({'ok': False, 'error': str(e)})
+    return json.dumps({'status': 'success', 'results': results})
+
+
+def _batch_response(result, error):
+    if error is None:
+        return result
+    return json.dumps({'status': 'failure', 'error': str(error), 'results': []})
+
+
+def run_batch(commands, mode='atomic'):
+    # Function to run many ledger commands in one transaction
+    return ledger_call(_batch_response, _run_batch, commands, mode)
+
+
+# remembers validators and parsed rows of scraped pages, see http_cache.py
+http_cache = HTTPCache(HTTP_CACHE_FILE, ttl=HTTP_CACHE_TTL)
 
 
 class CryptoScraper:
     # This class is used to get the real time data of Crypto from website
-    def __init__(self, url='https://coinranking.com/'):
+    def __init__(self, url=CRYPTO_URL, cache=None, backend=SCRAPE_BACKEND):
         # initialization of the class
         self.url = url
+        self.backend = backend  # how pages are parsed, see extractors.py
+        self.cache = cache if cache is not None else http_cache
+        self.session = requests.Session()
         self.crypto_names = []  # empty list to store crypto names
         self.crypto_prices = []  # empty list to store crypto prices
         self.crypto_market_caps = []  # empty list to store crypto market cap
 
     def fetch_data(self):
-        # fetch data using beautiful soup
-        response = requests.get(self.url)
-        webpage = response.text
-        soup = BeautifulSoup(webpage, 'html.parser')
+        # fetch data using beautiful soup, an unchanged page is not parsed again
+        page = self.cache.fetch(self.session, self.url, timeout=SCRAPE_TIMEOUT)
+        if page.changed:
+            rows = self.parse_page(page.text)
+            self.cache.store_parsed(self.url, rows)
+        else:
+            rows = page.parsed
 
-        self.crypto_names = soup.find_all(class_="profile__name")[:10]
-        all_valuta = soup.find_all(class_="valuta valuta--light")[:20]
+        self.crypto_names = [name for name, _, _ in rows]
+        self.crypto_prices = [price for _, price, _ in rows]
+        self.crypto_market_caps = [market_cap for _, _, market_cap in rows]
 
-        self.crypto_prices = all_valuta[::2]
-        self.crypto_market_caps = all_valuta[1::2]
+    def parse_page(self, webpage):
+        # [name, price, market cap] of the top 10 coins, as cleaned text
+        return extract_crypto(webpage, self.backend)
 
     def write_to_csv(self, filepath='cryptocurrencies.csv'):
         # write data into a csv file
@@ -294,23 +889,60 @@ class CryptoScraper:
             writer.writerow(['Name', 'Price', 'Market Cap'])
 
             for name, price, market_cap in zip(self.crypto_names, self.crypto_prices, self.crypto_market_caps):
-                cleaned_price = price.get_text(strip=True).replace(
-                    "\n", "").replace("        ", "")  # formation
-                cleaned_market_cap = market_cap.get_text(
-                    strip=True).replace("\n", "").replace("        ", "")
-                writer.writerow([name.get_text(strip=True),
-                                cleaned_price, cleaned_market_cap])
+                writer.writerow([name, price, market_cap])
 
         print(f"Data has been written to {filepath}.")
 
 
+class HostLimiter:
+    # Keeps the scraper polite: at most per_host requests in flight to one
+    # host, and at least delay seconds between the starts of two of them
+    def __init__(self, per_host=SCRAPE_PER_HOST, delay=SCRAPE_DELAY):
+        # initialization of the class
+        self.per_host = per_host
+        self.delay = delay
+        self.lock = threading.Lock()
+        self.slots = {}  # host -> semaphore
+        self.next_start = {}  # host -> earliest time the next request may start
+
+    @contextmanager
+    def limit(self, url):
+        host = urlsplit(url).netloc
+        with self.lock:
+            slot = self.slots.get(host)
+            if slot is None:
+                slot = self.slots[host] = threading.BoundedSemaphore(
+                    self.per_host)
+        with slot:
+            with self.lock:
+                now = time.monotonic()
+                start = max(now, self.next_start.get(host, now))
+                self.next_start[host] = start + self.delay
+            if start > now:
+                time.sleep(start - now)
+            yield
+
+
 class StockScraper:
     # class to perform data scraping for stocks data
-    def __init__(self, tick_file, output_file):
+    def __init__(self, tick_file, output_file, max_workers=SCRAPE_WORKERS,
+                 per_host=SCRAPE_PER_HOST, delay=SCRAPE_DELAY, cache=None,
+                 backend=SCRAPE_BACKEND, base_url=STOCK_BASE_URL):
         # initialization of the class
-        self.base_url = 'https://www.cnbc.com/quotes/'  # base url
+        self.backend = backend  # how pages are parsed, see extractors.py
+        self.cache = cache if cache is not None else http_cache
+        self.base_url = base_url  # quote page of a ticker is base_url + ticker
         self.tick_file = tick_file
         self.output_file = output_file
+        self.max_workers = max_workers  # pages fetched at the same time
+        self.limiter = HostLimiter(per_host, delay)
+        # one keep-alive session, so each host costs one TLS handshake per
+        # pooled connection instead of one per ticker
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=4, pool_maxsize=max_workers)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
         logging.basicConfig(filename='webscraping.log',
                             level=logging.DEBUG)  # log file
 
@@ -324,43 +956,51 @@ class StockScraper:
             return []
 
     def scrape_data(self):
-        # fetching data from website
+        # fetching data from website, returns the rows that were scraped
         tick_list = self.read_ticks()
         urls = [self.base_url + tick for tick in tick_list]
 
+        # pages are fetched in parallel, map hands the rows back in tick order
+        with ThreadPoolExecutor(max_workers=self.max_workers,
+                                thread_name_prefix='scraper') as executor:
+            rows = list(executor.map(self.scrape_url, urls))
+        # (tick, row or None) of the last scrape, for telling a page that
+        # failed from a tick that is no longer listed
+        self.scraped = list(zip(tick_list, rows))
+        if urls and not any(rows):
+            # keep the last good file rather than replacing it with nothing
+            raise RuntimeError(f'None of the {len(urls)} stock pages could be scraped')
+
         with open(self.output_file, 'w', newline='') as csvfile:
             # write data into csv file
             writer = csv.writer(csvfile)
             writer.writerow(['Name', 'Last Trade Time', 'Last Price'])
-            for url in urls:
-                try:
-                    response = requests.get(url)
-                    response.raise_for_status()
-                    soup = BeautifulSoup(response.text, 'html.parser')
-                    name, last_trade_time, last_price = self.parse_page(
-                        soup, url)
-                    if name and last_price:
-                        writer.writerow([name, last_trade_time, last_price])
-                except requests.exceptions.RequestException as err:
-                    logging.error(f"Request error for {url}: {err}")
-
-    def parse_page(self, soup, url):
-        # to get the last time of the trade
+            for row in rows:
+                if row:
+                    writer.writerow(row)
+        return [row for row in rows if row]
+
+    def scrape_url(self, url):
+        # fetch and parse one quote page, None if it could not be read.
+        # A page that has not changed reuses the row parsed last time
+        try:
+            with self.limiter.limit(url):
+                page = self.cache.fetch(
+                    self.session, url, timeout=SCRAPE_TIMEOUT)
+            if not page.changed:
+                return page.parsed
+            name, last_trade_time, last_price = self.parse_page(page.text, url)
+            row = [name, last_trade_time, last_price] if name and last_price else None
+            self.cache.store_parsed(url, row)
+            return row
+        except requests.exceptions.RequestException as err:
+            logging.error(f"Request error for {url}: {err}")
+        return None
+
+    def parse_page(self, webpage, url):
+        # to get the name, last time of the trade and the last price
         try:
-            name = soup.find(class_='QuoteStrip-name').text
-            last_trade_time_element = soup.find(
-                class_='QuoteStrip-extendedLastTradeTime')
-            last_trade_time = last_trade_time_element.text.replace(
-                "After Hours: Last | ", "") if last_trade_time_element else "N/A"
-
-            last_price_full = soup.find(
-                class_='QuoteStrip-lastPriceStripContainer').text
-            last_price = re.search(
-                r'[\d,]+\.\d+', last_price_full).group(0) if last_price_full else "N/A"
-            # re - regular expressions
-            # d - decimal point
-
-            return name, last_trade_time, last_price
+            return extract_stock(webpage, self.backend)
         except AttributeError as e:
             logging.error(f"Could not find data for {url}: {e}")
             return None, None, None
@@ -368,19 +1008,92 @@ class StockScraper:
 
 def update_crypto_data():
     # calling the function to update crypto data
-    scraper = CryptoScraper()
+    scraper = CryptoScraper(CRYPTO_URL)
     scraper.fetch_data()
     scraper.write_to_csv()
+    quotes = crypto_quotes(zip(
+        scraper.crypto_names, scraper.crypto_prices, scraper.crypto_market_caps))
+    quote_store.update(CRYPTO, quotes)
+    record_history(quotes)
     print("Cryptocurrency data updated.")
 
 
 def update_stock_data():
     # calling the function to update stocks data
-    scraper = StockScraper('ticks.csv', 'stocks.csv')
+    scraper = StockScraper('ticks.csv', 'stocks.csv', base_url=STOCK_BASE_URL)
     scraper.scrape_data()
+    quotes = [dict(quote, ticker=tick) for tick, row in scraper.scraped if row is not None
+              for quote in stock_quotes([row])]
+    listed = {tick for tick, row in scraper.scraped}
+    # a page that failed this time keeps its last quote, marked stale;
+    # quotes loaded from stocks.csv have no ticker and are kept too
+    quote_store.update(STOCKS, quotes, keep=lambda quote: quote.get('ticker') is None
+                       or quote['ticker'] in listed)
+    record_history(quotes)
     print("Stock data updated.")
 
 
+def record_history(quotes):
+    # keep every scraped price, the CSV files only have the latest
+    get_price_history().append((quote['symbol'], quote['price']) for quote in quotes)
+
+
+def stock_quotes(rows):
+    # [name, last trade time, last price] rows -> quotes
+    return [{'symbol': name, 'price': parse_price(price), 'last_trade_time': last_trade_time}
+            for name, last_trade_time, price in rows if parse_price(price) is not None]
+
+
+def crypto_quotes(rows):
+    # [name, price, market cap] rows -> quotes
+    return [{'symbol': name, 'price': parse_price(price), 'market_cap': market_cap}
+            for name, price, market_cap in rows if parse_price(price) is not None]
+
+
+def load_saved_quotes(stock_file='stocks.csv', crypto_file='cryptocurrencies.csv'):
+    # fill the quote store from the last scrape's files, so prices are
+    # there before the first background refresh finishes
+    for market, path, to_quotes in ((STOCKS, stock_file, stock_quotes),
+                                    (CRYPTO, crypto_file, crypto_quotes)):
+        try:
+            with open(path, newline='') as f:
+                rows = list(csv.reader(f))[1:]
+        except FileNotFoundError:
+            continue
+        quote_store.update(market, to_quotes(row for row in rows if len(row) == 3))
+
+
+# latest price of every stock and coin, filled by the scrapers
+quote_store = QuoteStore()
+
+# every scraped price over time, see price_history.py. Opened on first
+# use, so importing this module creates no files
+_price_history = None
+_price_history_lock = threading.Lock()
+
+
+def get_price_history():
+    global _price_history
+    with _price_history_lock:
+        if _price_history is None:
+            _price_history = PriceHistory(HISTORY_DIR)
+        return _price_history
+
+# sends quote changes to subscribed clients, see streaming.py
+quote_broadcaster = QuoteBroadcaster()
+quote_store.add_listener(quote_broadcaster.publish)
+
+# refreshes the scraped data in the background, see scheduler.py
+refresh_scheduler = RefreshScheduler()
+
+
+def start_refresh(stock_interval=STOCK_REFRESH_INTERVAL, crypto_interval=CRYPTO_REFRESH_INTERVAL):
+    # scrape now and then every interval seconds, without holding up the server
+    refresh_scheduler.add('stocks', update_stock_data, stock_interval)
+    refresh_scheduler.add('crypto', update_crypto_data, crypto_interval)
+    refresh_scheduler.start()
+
+
 def start_server():
     # This Function will start the server
     with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
@@ -394,8 +1107,58 @@ def start_server():
             thread.start()
 
 
+async def serve_async(workers=DB_WORKERS):
+    # single event loop for every connection, idle clients only cost a
+    # stream reader/writer pair instead of a whole OS thread
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='db') as executor:
+        server = await asyncio.start_server(
+            lambda reader, writer: handle_client_async(
+                reader, writer, executor),
+            HOST, PORT, backlog=1024)
+        print(f'Server listening on {HOST}:{PORT} (asyncio)')
+        async with server:
+            await server.serve_forever()
+
+
+def start_async_server(workers=DB_WORKERS):
+    # This Function will start the asyncio server
+    asyncio.run(serve_async(workers))
+
+
 """Main method to run the code"""
 if __name__ == '__main__':
-    update_stock_data()  # this process is lenghty so we are calling it first
-    update_crypto_data()  # this method will run cryptoscraper
-    start_server()  # this will start the server
+    parser = argparse.ArgumentParser(description='Finance tracker server')
+    parser.add_argument('--mode', choices=['async', 'thread'], default='async',
+                        help='asyncio event loop or one thread per connection')
+    parser.add_argument('--workers', type=int, default=DB_WORKERS,
+                        help='database threads used by the asyncio server')
+    parser.add_argument('--stock-interval', type=float, default=STOCK_REFRESH_INTERVAL,
+                        help='seconds between stock data refreshes')
+    parser.add_argument('--crypto-interval', type=float, default=CRYPTO_REFRESH_INTERVAL,
+                        help='seconds between cryptocurrency data refreshes')
+    parser.add_argument('--port', type=int, default=PORT, help='port to listen on')
+    parser.add_argument('--db', default=DATABASE, help='sqlite database file')
+    parser.add_argument('--no-refresh', action='store_true',
+                        help='only serve the saved prices, never scrape (e.g. for benchmarks)')
+    parser.add_argument('--stock-url', default=STOCK_BASE_URL,
+                        help='quote page URL a ticker is appended to')
+    parser.add_argument('--crypto-url', default=CRYPTO_URL, help='cryptocurrency list page')
+    parser.add_argument('--history-dir', default=HISTORY_DIR, help='directory of the price history')
+    args = parser.parse_args()
+
+    PORT = args.port
+    STOCK_BASE_URL = args.stock_url
+    CRYPTO_URL = args.crypto_url
+    HISTORY_DIR = args.history_dir
+    # only when started, so importing the module never creates a database
+    DATABASE = args.db
+    create_database_and_tables()
+
+    # scraping is lenghty, so it runs in the background while the server starts
+    load_saved_quotes()
+    if not args.no_refresh:
+        start_refresh(args.stock_interval, args.crypto_interval)
+    if args.mode == 'async':
+        start_async_server(args.workers)  # this will start the server
+    else:
+        start_server()
@@ -0,0 +1,134 @@
+"""Push price updates to subscribed clients
+
+A client sends subscribe|symbol|... and keeps the connection open. The
+quote store tells the broadcaster about every change, and the broadcaster
+hands each subscriber the part it asked for. That fan-out happens on the
+broadcaster's own thread, so a refresh never waits for subscribers.
+
+Each subscriber has a bounded set of pending changes keyed by symbol: a
+newer price replaces the one not sent yet (drop-to-latest), so a slow
+client only ever gets the latest prices. If it falls so far behind that
+the set is full, the pending changes are dropped and the client gets a
+full snapshot instead. The first message of a subscription is always a
+full snapshot.
+
+Messages use the get_quotes format: {'version', 'quotes', 'removed'}.
+"""
+import json
+import queue
+import threading
+
+MAX_PENDING = 10000  # symbols waiting for one subscriber before a resync
+
+
+class Subscription:
+    # What one subscriber asked for and what it has not been sent yet
+    def __init__(self, symbols, notify, max_pending=MAX_PENDING):
+        # initialization of the class
+        self.symbols = set(symbols) if symbols else None  # None means all
+        self.notify = notify  # called when there is something new to send
+        self.max_pending = max_pending
+        self.lock = threading.Lock()
+        self.pending = {}  # symbol -> latest quote not sent yet
+        self.removed = set()
+        self.version = 0
+        self.resync = True  # start with a full snapshot
+        self.closed = False
+
+    def offer(self, version, changed, removed):
+        # merge a change into what is pending, never blocks on the client
+        if self.symbols is not None:
+            changed = {symbol: quote for symbol, quote in changed.items()
+                       if symbol in self.symbols}
+            removed = [symbol for symbol in removed if symbol in self.symbols]
+        if not changed and not removed:
+            return
+        with self.lock:
+            if self.closed:
+                return
+            was_idle = not self.pending and not self.removed and not self.resync
+            if not self.resync:
+                for symbol in removed:
+                    self.pending.pop(symbol, None)
+                    self.removed.add(symbol)
+                for symbol, quote in changed.items():
+                    self.removed.discard(symbol)
+                    self.pending[symbol] = quote
+                if len(self.pending) + len(self.removed) > self.max_pending:
+                    # too far behind, a snapshot is cheaper than the backlog
+                    self.pending.clear()
+                    self.removed.clear()
+                    self.resync = True
+            self.version = max(self.version, version)
+        if was_idle:
+            self.notify()
+
+    def take(self, store):
+        # the next message to send as JSON text, None if nothing is pending
+        with self.lock:
+            if self.resync:
+                self.resync = False
+                self.pending.clear()
+                self.removed.clear()
+                resync = True
+            elif self.pending or self.removed:
+                resync = False
+                message = {'version': self.version, 'quotes': self.pending,
+                           'removed': sorted(self.removed)}
+                self.pending = {}
+                self.removed = set()
+            else:
+                return None
+        if resync:
+            symbols = sorted(self.symbols) if self.symbols is not None else None
+            message = store.snapshot(symbols)
+        return json.dumps(message)
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            self.pending.clear()
+            self.removed.clear()
+
+
+class QuoteBroadcaster:
+    # Fans quote store changes out to every subscription
+    def __init__(self):
+        # initialization of the class
+        self.lock = threading.Lock()
+        self.subscriptions = set()
+        self.changes = queue.SimpleQueue()
+        self.thread = threading.Thread(
+            target=self.run, name='quote-broadcaster', daemon=True)
+        self.thread.start()
+
+    def subscribe(self, symbols, notify, max_pending=MAX_PENDING):
+        subscription = Subscription(symbols, notify, max_pending)
+        with self.lock:
+            self.subscriptions.add(subscription)
+        subscription.notify()  # the first snapshot is ready straight away
+        return subscription
+
+    def unsubscribe(self, subscription):
+        subscription.close()
+        with self.lock:
+            self.subscriptions.discard(subscription)
+
+    def publish(self, version, changed, removed):
+        # quote store listener, only queues the change
+        self.changes.put((version, changed, removed))
+
+    def run(self):
+        while True:
+            version, changed, removed = self.changes.get()
+            with self.lock:
+                subscriptions = list(self.subscriptions)
+            for subscription in subscriptions:
+                try:
+                    subscription.offer(version, changed, removed)
+                except Exception as e:
+                    print(f'Could not queue quotes for a subscriber: {e}')
+
+    def count(self):
+        with self.lock:
+            return len(self.subscriptions)
@@ -0,0 +1,54 @@
+"""Every extraction backend gives the same result on saved pages"""
+import os
+
+import pytest
+
+from extractors import BACKENDS, compare_backends, extract_crypto, extract_stock
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+
+def read_fixture(name):
+    with open(os.path.join(FIXTURES, name), encoding='utf-8') as f:
+        return f.read()
+
+
+def fixtures(prefix):
+    return sorted(name for name in os.listdir(FIXTURES) if name.startswith(prefix))
+
+
+@pytest.mark.parametrize('name', fixtures('stock_'))
+def test_stock_backends_agree(name):
+    results = compare_backends('stock', read_fixture(name))
+    assert set(results) == set(BACKENDS)
+    assert all(result == results['soup'] for result in results.values()), results
+
+
+@pytest.mark.parametrize('name', fixtures('crypto'))
+def test_crypto_backends_agree(name):
+    results = compare_backends('crypto', read_fixture(name))
+    assert all(result == results['soup'] for result in results.values()), results
+
+
+@pytest.mark.parametrize('backend', BACKENDS)
+def test_stock_quote(backend):
+    # an extra class on the quote elements, script and style text left out
+    assert extract_stock(read_fixture('stock_after_hours.html'), backend) == \
+        ('Apple Inc & Co', '7:59 PM EDT', '1,230.45')
+    assert extract_stock(read_fixture('stock_regular_hours.html'), backend) == \
+        ('Tesla Inc', 'N/A', '245.10')
+
+
+@pytest.mark.parametrize('backend', BACKENDS)
+def test_stock_without_quote(backend):
+    with pytest.raises(AttributeError):
+        extract_stock(read_fixture('stock_no_quote.html'), backend)
+
+
+@pytest.mark.parametrize('backend', BACKENDS)
+def test_crypto_coins(backend):
+    # ten coins, the valuta with an extra class is not one of them
+    coins = extract_crypto(read_fixture('crypto.html'), backend)
+    assert len(coins) == 10
+    assert coins[0] == ['Coin 0C0', '$0,023.05', '$ 1.0 billion']
+    assert coins[9] == ['Coin 9C9', '$9,923.95', '$ 10.9 billion']
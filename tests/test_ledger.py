@@ -0,0 +1,171 @@
+"""Ledger commands, batches, migrations and paging on a throwaway users.db"""
+import json
+import sqlite3
+from concurrent.futures import Future
+
+import pytest
+
+import server
+from cache import AccountCache
+from db_pool import get_pool
+from ledger import LedgerWriter
+from migrations import MIGRATIONS, migrate
+from protocol import make_command, make_request, split_command, split_request
+
+
+@pytest.fixture
+def database(tmp_path, monkeypatch):
+    # a fresh users.db with alice (100) and bob (0), and an empty account cache
+    path = str(tmp_path / 'users.db')
+    monkeypatch.setattr(server, 'DATABASE', path)
+    monkeypatch.setattr(server, 'account_cache', AccountCache(server.load_account))
+    server.create_database_and_tables()
+    server.register_user('alice', 'secret')
+    server.register_user('bob', 'secret')
+    assert server.deposit('alice', 100) == 'Deposit successful.'
+    return path
+
+
+def balance(database, username):
+    # straight from the file, not from the account cache
+    conn = sqlite3.connect(database)
+    try:
+        return conn.execute('SELECT balance FROM users WHERE username = ?', (username,)).fetchone()[0]
+    finally:
+        conn.close()
+
+
+def transaction_count(database):
+    conn = sqlite3.connect(database)
+    try:
+        return conn.execute('SELECT COUNT(*) FROM transactions').fetchone()[0]
+    finally:
+        conn.close()
+
+
+def test_atomic_batch_saves_nothing_when_a_command_fails(database):
+    commands = [make_command('deposit', 'alice', 50), make_command('withdraw', 'alice', 1000)]
+    result = json.loads(server.run_batch(commands, 'atomic'))
+    assert result['status'] == 'failure'
+    assert result['failed_index'] == 1
+    assert result['results'][1] == {'ok': False, 'error': 'Insufficient funds'}
+    assert balance(database, 'alice') == 100
+    assert server.get_balance('alice') == 100
+
+
+def test_best_effort_batch_skips_failed_commands(database):
+    commands = [make_command('deposit', 'alice', 50), make_command('withdraw', 'alice', 1000),
+                make_command('deposit', 'bob', 20)]
+    result = json.loads(server.run_batch(commands, 'best_effort'))
+    assert result['status'] == 'success'
+    assert [item['ok'] for item in result['results']] == [True, False, True]
+    assert balance(database, 'alice') == 150
+    assert balance(database, 'bob') == 20
+    assert server.get_balance('alice') == 150
+
+
+def test_malformed_batch_is_refused(database):
+    for request in (['batch', 'atomic'], ['batch', 'atomic', '{not json'],
+                    ['batch', 'atomic', '[1, 2]']):
+        result = json.loads(server.dispatch(request))
+        assert result['status'] == 'failure'
+        assert result['results'] == []
+
+
+def test_unknown_user_cannot_deposit_or_withdraw(database):
+    before = transaction_count(database)
+    assert server.deposit('nobody', 10) == 'User not found.'
+    assert server.withdraw_money('nobody', 10) == 'User not found.'
+    assert server.get_balance('nobody') == 'Unknown user'
+    assert transaction_count(database) == before
+
+
+def test_group_commit_outcomes(database):
+    # one group with a command that works, one that is refused and one that
+    # was cancelled while queued: only the first is saved and reported to
+    # the commit hooks, and every future gets its own outcome
+    writer = LedgerWriter(database)
+    committed = []
+    writer.add_commit_hook(lambda conn, commands: committed.extend(commands))
+    group = [(server._deposit, ('alice', 5), Future()),
+             (server._withdraw_money, ('alice', 1000), Future()),
+             (server._deposit, ('alice', 7), Future())]
+    group[2][2].cancel()
+
+    writer.apply(get_pool(database).get(), group)
+
+    assert group[0][2].result() == 'Deposit successful.'
+    with pytest.raises(server.LedgerError, match='Insufficient funds'):
+        group[1][2].result()
+    assert group[2][2].cancelled()
+    assert committed == [(server._deposit, ('alice', 5))]
+    assert (writer.groups, writer.commands) == (1, 2)
+    assert balance(database, 'alice') == 105
+
+
+@pytest.mark.parametrize('fields', [
+    ('deposit', 'alice', '10'),
+    ('register', 'a|b', 'pass|word'),
+    ('register', 'back\\slash', 'ends with\\'),
+    ('register', '\\|', '|\\'),
+    ('get_quotes', '', ''),
+])
+def test_command_escaping_round_trips(fields):
+    assert split_command(make_command(*fields)) == list(fields)
+    assert split_request(make_request('7', *fields)) == ('7', list(fields))
+
+
+def test_migration_merges_duplicate_positions(tmp_path):
+    # a users.db from before the migrations, where invest added a row per purchase
+    conn = sqlite3.connect(str(tmp_path / 'users.db'))
+    conn.execute('''CREATE TABLE portfolios
+                    (id INTEGER PRIMARY KEY AUTOINCREMENT, username TEXT NOT NULL,
+                     market TEXT NOT NULL, quantity INTEGER NOT NULL, amount REAL NOT NULL,
+                     timestamp DATETIME DEFAULT CURRENT_TIMESTAMP)''')
+    conn.execute('''CREATE TABLE transactions
+                    (id INTEGER PRIMARY KEY AUTOINCREMENT, username TEXT NOT NULL,
+                     transaction_type TEXT NOT NULL, amount REAL NOT NULL, market TEXT,
+                     timestamp DATETIME DEFAULT CURRENT_TIMESTAMP)''')
+    conn.executemany('INSERT INTO portfolios (username, market, quantity, amount) VALUES (?, ?, ?, ?)',
+                     [('alice', 'AAPL', 2, 200.0), ('alice', 'TSLA', 1, 100.0),
+                      ('alice', 'AAPL', 3, 330.0), ('bob', 'AAPL', 1, 110.0)])
+    conn.commit()
+
+    assert migrate(conn) == MIGRATIONS[-1][0]
+
+    rows = conn.execute('''SELECT id, username, market, quantity, amount FROM portfolios
+                           ORDER BY id''').fetchall()
+    assert rows == [(1, 'alice', 'AAPL', 5, 530.0), (2, 'alice', 'TSLA', 1, 100.0),
+                    (4, 'bob', 'AAPL', 1, 110.0)]
+    with pytest.raises(sqlite3.IntegrityError):
+        conn.execute("INSERT INTO portfolios (username, market, quantity, amount) VALUES ('bob', 'AAPL', 1, 1)")
+    assert migrate(conn) == MIGRATIONS[-1][0]  # nothing left to do
+    conn.close()
+
+
+def read_page(response):
+    # (transactions, next cursor) of a get_transactions answer
+    parts = [json.loads(part) for part in response]
+    assert [part['more'] for part in parts] == [True] * (len(parts) - 1) + [False]
+    return [item for part in parts for item in part['transactions']], parts[-1]['next']
+
+
+def test_transaction_pages_across_equal_timestamps(database):
+    conn = sqlite3.connect(database)
+    conn.executemany("""INSERT INTO transactions (username, transaction_type, amount, timestamp)
+                        VALUES ('bob', 'deposit', ?, ?)""",
+                     [(i, '2024-01-02 10:00:00' if i < 7 else '2024-01-01 09:00:00')
+                      for i in range(1, 10)])
+    conn.commit()
+    expected = [row[0] for row in conn.execute("""SELECT id FROM transactions WHERE username = 'bob'
+                                                  ORDER BY timestamp DESC, id DESC""")]
+    conn.close()
+
+    seen, cursor = [], None
+    while True:
+        transactions, cursor = read_page(server.get_transactions('bob', limit=2, cursor=cursor))
+        seen += [transaction['id'] for transaction in transactions]
+        if cursor is None:
+            break
+    assert seen == expected
+    assert len(seen) == 9
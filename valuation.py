@@ -0,0 +1,99 @@
+"""Mark-to-market valuation of portfolios
+
+A position only stores what was paid for it. To value it, the positions
+are joined against the latest prices in bulk: a position's value is
+quantity * price and its unrealized P&L is value - amount paid. Per-user
+totals are a single groupby. Everything works on whole columns, so an
+end-of-day revaluation of every portfolio is one pass over a DataFrame
+instead of a query and a loop per user.
+
+A position whose market has no price is kept with NaN price, value and
+P&L. It counts towards a user's cost but not their value or P&L, and it
+is counted as unpriced.
+
+To time it on made-up data run
+
+    python valuation.py [users] [positions per user]
+"""
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+POSITION_COLUMNS = ['username', 'market', 'quantity', 'amount']
+
+
+def load_positions(cursor, username=None):
+    # every position in the portfolios table, or one user's
+    if username is None:
+        cursor.execute('SELECT username, market, quantity, amount FROM portfolios')
+    else:
+        cursor.execute('SELECT username, market, quantity, amount FROM portfolios WHERE username = ?',
+                       (username,))
+    return pd.DataFrame.from_records(cursor.fetchall(), columns=POSITION_COLUMNS)
+
+
+def value_positions(positions, prices):
+    # positions with price, value and pnl columns added. prices maps a
+    # market to its latest price. Each market is looked up once, not once
+    # per position
+    codes, markets = pd.factorize(positions['market'])
+    price = pd.Series(prices, dtype=float).reindex(markets).to_numpy()[codes]
+    value = positions['quantity'].to_numpy(dtype=float) * price
+    return positions.assign(price=price, value=value,
+                            pnl=value - positions['amount'].to_numpy(dtype=float))
+
+
+def user_totals(valued):
+    # per user: positions, cost, value, pnl and unpriced positions, indexed
+    # by username in order of first appearance
+    codes, usernames = pd.factorize(valued['username'])
+    unpriced = np.isnan(valued['price'].to_numpy())
+
+    def per_user(values):
+        return np.bincount(codes, weights=values, minlength=len(usernames))
+
+    return pd.DataFrame({
+        'positions': np.bincount(codes, minlength=len(usernames)),
+        'cost': per_user(valued['amount'].to_numpy(dtype=float)),
+        'value': per_user(np.where(unpriced, 0.0, valued['value'].to_numpy())),
+        'pnl': per_user(np.where(unpriced, 0.0, valued['pnl'].to_numpy())),
+        'unpriced': per_user(unpriced).astype(int),
+    }, index=pd.Index(usernames, name='username'))
+
+
+def revalue(positions, prices):
+    # (valued positions, per user totals)
+    valued = value_positions(positions, prices)
+    return valued, user_totals(valued)
+
+
+def to_records(frame):
+    # a frame as a list of dicts that json can write, NaN becomes None
+    return frame.astype(object).where(frame.notna(), None).to_dict('records')
+
+
+def sample_positions(users, per_user, markets=500, seed=0):
+    # made-up positions and prices for timing
+    rng = np.random.default_rng(seed)
+    count = users * per_user
+    symbols = np.array([f'M{i}' for i in range(markets)])
+    positions = pd.DataFrame({
+        'username': np.repeat(np.array([f'user{i}' for i in range(users)]), per_user),
+        'market': symbols[rng.integers(0, markets, count)],
+        'quantity': rng.integers(1, 100, count),
+        'amount': rng.uniform(1, 10000, count),
+    })
+    prices = dict(zip(symbols[:-1], rng.uniform(1, 500, markets - 1)))  # one unpriced
+    return positions, prices
+
+
+if __name__ == '__main__':
+    users = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    per_user = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    positions, prices = sample_positions(users, per_user)
+    started = time.perf_counter()
+    valued, totals = revalue(positions, prices)
+    elapsed = time.perf_counter() - started
+    print(f'{len(valued)} positions of {len(totals)} users valued in {elapsed:.3f}s')